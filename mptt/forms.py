@@ -3,32 +3,155 @@ Form components for working with trees.
 """
 from django import forms
 from django.forms.forms import NON_FIELD_ERRORS
+from django.forms.models import ModelChoiceIterator
 from django.forms.util import ErrorList
 from django.utils.encoding import smart_unicode
 from django.utils.translation import ugettext_lazy as _
 
 from mptt.exceptions import InvalidMove
+from mptt.utils import _get_request_cache
 
 __all__ = ('TreeNodeChoiceField', 'TreeNodePositionField', 'MoveNodeForm')
 
 # Fields ######################################################################
 
+class TreeNodeChoiceIterator(ModelChoiceIterator):
+    """
+    Generates the choices for a ``TreeNodeChoiceField``, optionally
+    from ``values_list`` rows rather than model instances and from a
+    cache shared between fields which is kept until the tree changes.
+    """
+    def __init__(self, field):
+        super(TreeNodeChoiceIterator, self).__init__(field)
+        # Only limit the choices rendered - validation still uses a
+        # lookup against the whole queryset.
+        if field.max_level is not None:
+            self.queryset = self.queryset.filter(**{
+                '%s__lte' % self.queryset.model._meta.level_attr: field.max_level,
+            })
+        if field.excluded_subtree is not None:
+            node = field.excluded_subtree
+            opts = node._meta
+            self.queryset = self.queryset.exclude(**{
+                opts.tree_id_attr: getattr(node, opts.tree_id_attr),
+                '%s__gte' % opts.left_attr: getattr(node, opts.left_attr),
+                '%s__lte' % opts.right_attr: getattr(node, opts.right_attr),
+            })
+
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield (u"", self.field.empty_label)
+        if self.field.cache_choices:
+            choices = self.get_cached_choices()
+        else:
+            choices = self.get_choices()
+        for choice in choices:
+            yield choice
+
+    def get_choices(self):
+        field = self.field
+        if field.label_field is None:
+            for obj in self.queryset.all():
+                yield self.choice(obj)
+        else:
+            rows = self.queryset.values_list(field.to_field_name or 'pk',
+                self.queryset.model._meta.level_attr, field.label_field)
+            for key, level, label in rows:
+                yield (key, field.label_from_values(level, label))
+
+    def get_cached_choices(self):
+        field = self.field
+        version = self.queryset.model._tree_manager.get_tree_version()
+        key = (field.__class__, str(self.queryset.query),
+               field.level_indicator, field.label_field, field.to_field_name)
+        choice_cache = _get_request_cache('tree_choices')
+        cached = choice_cache.get(key)
+        if cached is None or cached[0] != version:
+            if key not in choice_cache and \
+               len(choice_cache) >= MAX_CACHED_TREE_CHOICES:
+                choice_cache.clear()
+            cached = choice_cache[key] = (version, list(self.get_choices()))
+        return cached[1]
+
+# Choices generated by TreeNodeChoiceFields with cache_choices set are
+# kept for the current request with the tree version they were generated
+# at, and discarded once more than MAX_CACHED_TREE_CHOICES sets have been
+# kept.
+MAX_CACHED_TREE_CHOICES = 20
+
 class TreeNodeChoiceField(forms.ModelChoiceField):
-    """A ModelChoiceField for tree nodes."""
+    """
+    A ModelChoiceField for tree nodes.
+
+    If a ``max_level`` keyword argument is given, only nodes at or above
+    that tree level will be rendered as options, while any node in the
+    field's ``queryset`` will still be accepted. A ``children_url``
+    keyword argument gives the URL of a view such as
+    ``mptt.views.node_children`` from which client-side code may load
+    the children of rendered nodes on demand.
+
+    If an ``excluded_subtree`` keyword argument is given, that node and
+    its descendants won't be rendered as options, though they will
+    still be accepted.
+
+    If a ``label_field`` keyword argument is given, option labels will
+    be created from that field's value using ``values_list``, without
+    creating model instances. If ``cache_choices`` is ``True``, choices
+    will be shared by fields with the same queryset and options until
+    the tree changes or the current request finishes.
+    """
     def __init__(self, level_indicator=u'---', *args, **kwargs):
         self.level_indicator = level_indicator
+        self.max_level = kwargs.pop('max_level', None)
+        self.label_field = kwargs.pop('label_field', None)
+        self.excluded_subtree = kwargs.pop('excluded_subtree', None)
+        children_url = kwargs.pop('children_url', None)
         if kwargs.get('required', True) and not 'empty_label' in kwargs:
             kwargs['empty_label'] = None
         super(TreeNodeChoiceField, self).__init__(*args, **kwargs)
+        if children_url is not None:
+            self.widget.attrs['data-children-url'] = children_url
+
+    def _get_level_indicator(self):
+        return self._level_indicator
+
+    def _set_level_indicator(self, level_indicator):
+        self._level_indicator = level_indicator
+        self._level_prefixes = []
+
+    level_indicator = property(_get_level_indicator, _set_level_indicator)
+
+    def _get_level_prefix(self, level):
+        """
+        Returns the text which precedes the labels of nodes at the given
+        tree ``level``, which is only built once for each level.
+        """
+        prefixes = self._level_prefixes
+        while len(prefixes) <= level:
+            prefixes.append(u'%s ' % (self._level_indicator * len(prefixes)))
+        return prefixes[level]
 
     def label_from_instance(self, obj):
         """
         Creates labels which represent the tree level of each node when
         generating option labels.
         """
-        return u'%s %s' % (self.level_indicator * getattr(obj,
-                                                  obj._meta.level_attr),
-                           smart_unicode(obj))
+        return self.label_from_values(getattr(obj, obj._meta.level_attr),
+                                      smart_unicode(obj))
+
+    def label_from_values(self, level, label):
+        """
+        Creates an option label for a node at the given tree ``level``
+        from its ``label``.
+        """
+        return self._get_level_prefix(level) + smart_unicode(label)
+
+    def _get_choices(self):
+        if hasattr(self, '_choices'):
+            return self._choices
+        return TreeNodeChoiceIterator(self)
+
+    choices = property(_get_choices, forms.ChoiceField._set_choices)
 
 class TreeNodePositionField(forms.ChoiceField):
     """A ChoiceField for specifying position relative to another node."""
@@ -69,7 +192,8 @@ class MoveNodeForm(forms.Form):
            Specifies a ``QuerySet`` of valid targets for the move. If
            not provided, valid targets will consist of everything other
            node of the same type, apart from the node itself and any
-           descendants.
+           descendants. The node itself and its descendants are never
+           valid targets, which is checked using their tree fields.
 
            For example, if you want to restrict the node to moving
            within its own tree, pass a ``QuerySet`` containing
@@ -96,13 +220,12 @@ class MoveNodeForm(forms.Form):
         position_choices = kwargs.pop('position_choices', None)
         level_indicator = kwargs.pop('level_indicator', None)
         super(MoveNodeForm, self).__init__(*args, **kwargs)
-        opts = node._meta
         if valid_targets is None:
-            valid_targets = node._tree_manager.exclude(**{
-                opts.tree_id_attr: getattr(node, opts.tree_id_attr),
-                '%s__gte' % opts.left_attr: getattr(node, opts.left_attr),
-                '%s__lte' % opts.right_attr: getattr(node, opts.right_attr),
-            })
+            # Don't render the node or its descendants as options, but
+            # leave it to clean_target to reject them, so submitted
+            # targets are validated by primary key lookup alone.
+            valid_targets = node._tree_manager.all()
+            self.fields['target'].excluded_subtree = node
         self.fields['target'].queryset = valid_targets
         self.fields['target'].widget.attrs['size'] = target_select_size
         if level_indicator:
@@ -110,6 +233,17 @@ class MoveNodeForm(forms.Form):
         if position_choices:
             self.fields['position_choices'].choices = position_choices
 
+    def clean_target(self):
+        """
+        Checks that the target isn't the node being moved or one of its
+        descendants.
+        """
+        target = self.cleaned_data['target']
+        if target is not None and target.is_descendant_of(self.node,
+                                                          include_self=True):
+            raise forms.ValidationError(_('A node may not be moved relative to itself or any of its descendants.'))
+        return target
+
     def save(self):
         """
         Attempts to move the node using the selected target and
@@ -1,14 +1,51 @@
 """
 A custom manager for working with trees of objects.
 """
+import itertools
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_finished
 from django.db import connection, models, transaction
+from django.db.models import F
+from django.db.models.query import QuerySet
 from django.utils.translation import ugettext as _
 
 from mptt.exceptions import InvalidMove
+from mptt.signals import node_moved
+from mptt.utils import _get_cached_queryset, prefetch_tree_relations
 
-__all__ = ('TreeManager',)
+__all__ = ('TreeManager', 'TreeQuerySet', 'reset_pending_tree_versions')
 
-qn = connection.ops.quote_name
+def qn(name):
+    """
+    Quotes ``name`` for use in raw SQL, using the connection's
+    operations as they are when the SQL is built rather than when this
+    module was imported.
+    """
+    return connection.ops.quote_name(name)
+
+# Tree versions, keyed by table name. A table's version is changed
+# whenever its trees are written to, so anything cached from them can
+# tell when it may have gone stale.
+_tree_versions = {}
+_tree_version_counter = itertools.count(1)
+
+# Shared tree versions are kept in the cache, so they're changed for
+# every process using it. Tables written to during a thread's managed
+# transaction have theirs changed again once it has been committed - when
+# the request finishes, or when reset_pending_tree_versions() is called -
+# as anything cached before then may be stale.
+SHARED_TREE_VERSION_KEY = 'mptt.tree_version.%s'
+_pending_shared_versions = threading.local()
+
+# The cursor shared by the raw statements of the tree operation in
+# progress in the current thread, and the number of statements executed
+# by the last operation on each table.
+_operations = threading.local()
 
 COUNT_SUBQUERY = """(
     SELECT COUNT(*)
@@ -29,6 +66,126 @@ CUMULATIVE_COUNT_SUBQUERY = """(
     )
 )"""
 
+RECURSIVE_CUMULATIVE_COUNT_SUBQUERY = """(
+    SELECT COUNT(*)
+    FROM %(rel_table)s
+    WHERE %(mptt_fk)s IN
+    (
+        WITH RECURSIVE descendants(%(mptt_pk)s) AS (
+            SELECT %(mptt_table)s.%(mptt_pk)s
+            UNION ALL
+            SELECT m2.%(mptt_pk)s
+            FROM %(mptt_table)s m2
+            INNER JOIN descendants
+                ON m2.%(parent)s = descendants.%(mptt_pk)s
+        )
+        SELECT %(mptt_pk)s FROM descendants
+    )
+)"""
+
+RECURSIVE_ANCESTORS_WHERE = """%(mptt_table)s.%(mptt_pk)s IN (
+    WITH RECURSIVE ancestors(%(mptt_pk)s) AS (
+        SELECT %(parent)s
+        FROM %(mptt_table)s
+        WHERE %(mptt_pk)s = %%s
+        UNION ALL
+        SELECT m2.%(parent)s
+        FROM %(mptt_table)s m2
+        INNER JOIN ancestors
+            ON m2.%(mptt_pk)s = ancestors.%(mptt_pk)s
+    )
+    SELECT %(mptt_pk)s FROM ancestors
+)"""
+
+RECURSIVE_DESCENDANTS_WHERE = """(%(include_self)s %(mptt_table)s.%(mptt_pk)s IN (
+    WITH RECURSIVE descendants(%(mptt_pk)s, depth) AS (
+        SELECT %(mptt_pk)s, 1
+        FROM %(mptt_table)s
+        WHERE %(parent)s = %%s
+        UNION ALL
+        SELECT m2.%(mptt_pk)s, descendants.depth + 1
+        FROM %(mptt_table)s m2
+        INNER JOIN descendants
+            ON m2.%(parent)s = descendants.%(mptt_pk)s
+        %(max_depth)s
+    )
+    SELECT %(mptt_pk)s FROM descendants
+    %(min_depth)s
+))"""
+
+SIBLINGS_WINDOW_WHERE = """%(mptt_table)s.%(order)s >= COALESCE((
+    SELECT s.%(order)s
+    FROM %(mptt_table)s s
+    WHERE s.%(siblings)s AND s.%(order)s < %%s
+    ORDER BY s.%(order)s DESC
+    LIMIT 1 OFFSET %%s
+), %(mptt_table)s.%(order)s)
+AND %(mptt_table)s.%(order)s <= COALESCE((
+    SELECT s.%(order)s
+    FROM %(mptt_table)s s
+    WHERE s.%(siblings)s AND s.%(order)s > %%s
+    ORDER BY s.%(order)s ASC
+    LIMIT 1 OFFSET %%s
+), %(mptt_table)s.%(order)s)"""
+
+class _CountingCursor(object):
+    """
+    Wraps a database cursor, counting the statements executed with it
+    towards the tree operation in progress.
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.round_trips = 0
+
+    def execute(self, sql, params=()):
+        self.round_trips += 1
+        return self.cursor.execute(sql, params)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+def _tree_operation(method):
+    """
+    Decorates a ``TreeManager`` method which writes to the tree, so the
+    raw statements it executes - including those of any operations it
+    performs in turn - share one cursor and are counted as one
+    operation.
+    """
+    def wrapper(self, *args, **kwargs):
+        depth = getattr(_operations, 'depth', 0)
+        if not depth:
+            _operations.cursor = None
+        _operations.depth = depth + 1
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            _operations.depth = depth
+            if not depth:
+                cursor = _operations.cursor
+                _operations.cursor = None
+                round_trips = getattr(_operations, 'round_trips', {})
+                round_trips[self.model._meta.db_table] = \
+                    cursor and cursor.round_trips or 0
+                _operations.round_trips = round_trips
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+class TreeQuerySet(QuerySet):
+    """
+    A ``QuerySet`` for working with trees of objects.
+    """
+    def prefetch_tree_relations(self, children=True, ancestors=False,
+                                descendants=False):
+        """
+        Returns a copy of this ``QuerySet`` which has already been
+        evaluated, with the relations of each of its items loaded as
+        specified by the given arguments - see
+        ``mptt.utils.prefetch_tree_relations``.
+        """
+        return _get_cached_queryset(self._clone(), prefetch_tree_relations(
+            self, children, ancestors, descendants))
+
 class TreeManager(models.Manager):
     """
     A manager for working with trees of objects.
@@ -78,25 +235,205 @@ class TreeManager(models.Manager):
            If ``True``, the count will be for each item and all of its
            descendants, otherwise it will be for each item itself.
         """
+        subquery = self._get_related_count_subquery(rel_model, rel_field,
+                                                    cumulative)
+        return queryset.extra(select={count_attr: subquery})
+
+    def get_ancestors(self, node, ascending=False, queryset=None):
+        """
+        Creates a ``QuerySet`` containing the ancestors of ``node``.
+
+        This defaults to being in descending order (root ancestor first,
+        immediate parent last); passing ``True`` for the ``ascending``
+        argument will reverse the ordering (immediate parent first, root
+        ancestor last).
+
+        If a ``queryset`` is given, the ancestors will be selected from
+        it rather than from all the nodes this manager provides.
+
+        The query used depends on the ``query_strategy`` tree option of
+        the model being managed.
+        """
+        if queryset is None:
+            queryset = self.get_query_set()
+        if node.is_root_node():
+            return queryset.none()
+
+        if self._uses_recursive_queries():
+            queryset = self._get_recursive_queryset(queryset,
+                RECURSIVE_ANCESTORS_WHERE, [node.pk])
+        else:
+            queryset = queryset.filter(**{
+                '%s__lt' % self.left_attr: getattr(node, self.left_attr),
+                '%s__gt' % self.right_attr: getattr(node, self.right_attr),
+                self.tree_id_attr: getattr(node, self.tree_id_attr),
+            })
+        return queryset.order_by('%s%s' % ({True: '-', False: ''}[ascending],
+                                           self.left_attr))
+
+    def get_cached_trees(self, queryset=None):
+        """
+        Evaluates ``queryset`` (all nodes by default) with a single
+        query and returns a list of its top-level nodes - those whose
+        parent is not also in ``queryset`` - in tree order.
+
+        The children and parent of every node are cached from the
+        same results, so the trees may be walked with ``get_children()``
+        and ``parent`` without any further database access. Children
+        which are not in ``queryset`` will not be included.
+        """
+        if queryset is None:
+            queryset = self.all()
         opts = self.model._meta
-        if cumulative:
-            subquery = CUMULATIVE_COUNT_SUBQUERY % {
-                'rel_table': qn(rel_model._meta.db_table),
-                'mptt_fk': qn(rel_model._meta.get_field(rel_field).column),
-                'mptt_table': qn(opts.db_table),
-                'mptt_pk': qn(opts.pk.column),
-                'tree_id': qn(opts.get_field(self.tree_id_attr).column),
-                'left': qn(opts.get_field(self.left_attr).column),
-                'right': qn(opts.get_field(self.right_attr).column),
-            }
+        parent_id_attr = '%s_id' % self.parent_attr
+        parent_cache_name = opts.get_field(self.parent_attr).get_cache_name()
+        nodes = list(queryset.order_by(self.tree_id_attr, self.left_attr))
+        children_by_parent = dict([(node.pk, []) for node in nodes])
+        top_nodes = []
+        for node in nodes:
+            parent_id = getattr(node, parent_id_attr)
+            if parent_id in children_by_parent:
+                children_by_parent[parent_id].append(node)
+            else:
+                top_nodes.append(node)
+        for node in nodes:
+            node_children = children_by_parent[node.pk]
+            for child in node_children:
+                setattr(child, parent_cache_name, node)
+            if not node.is_leaf_node():
+                node._get_traversal_cache()['children'] = _get_cached_queryset(
+                    self.filter(**{self.parent_attr: node}), node_children)
+        return top_nodes
+
+    def get_descendants(self, node, include_self=False, min_depth=None,
+                        max_depth=None):
+        """
+        Creates a ``QuerySet`` containing descendants of ``node``, in
+        tree order.
+
+        If ``include_self`` is ``True``, the ``QuerySet`` will also
+        include ``node`` itself.
+
+        If ``min_depth`` or ``max_depth`` are given, only descendants
+        which are at least or at most that many levels below ``node``
+        will be included; ``node``'s children are one level below it.
+        As ``node`` itself is zero levels below, a ``min_depth`` greater
+        than zero overrides ``include_self``.
+
+        The query used depends on the ``query_strategy`` tree option of
+        the model being managed.
+        """
+        include_self = include_self and not min_depth
+        if max_depth is not None and max_depth <= 0:
+            if include_self and max_depth == 0:
+                return self.filter(pk=node.pk)
+            return self.none()
+
+        opts = self.model._meta
+        if self._uses_recursive_queries():
+            params = [node.pk]
+            clauses = {}
+            if include_self:
+                params.insert(0, node.pk)
+                clauses['include_self'] = '%s.%s = %%s OR' % (
+                    qn(opts.db_table), qn(opts.pk.column))
+            if max_depth is not None:
+                params.append(max_depth)
+                clauses['max_depth'] = 'WHERE descendants.depth < %s'
+            if min_depth is not None:
+                params.append(min_depth)
+                clauses['min_depth'] = 'WHERE depth >= %s'
+            return self._get_recursive_queryset(self.get_query_set(),
+                RECURSIVE_DESCENDANTS_WHERE, params, **clauses)
+
+        if not include_self and node.is_leaf_node():
+            return self.none()
+
+        level = getattr(node, self.level_attr)
+        filters = {self.tree_id_attr: getattr(node, self.tree_id_attr)}
+        if include_self:
+            filters['%s__range' % self.left_attr] = (getattr(node, self.left_attr),
+                                                     getattr(node, self.right_attr))
         else:
-            subquery = COUNT_SUBQUERY % {
-                'rel_table': qn(rel_model._meta.db_table),
-                'mptt_fk': qn(rel_model._meta.get_field(rel_field).column),
-                'mptt_table': qn(opts.db_table),
-                'mptt_pk': qn(opts.pk.column),
-            }
-        return queryset.extra(select={count_attr: subquery})
+            filters['%s__gt' % self.left_attr] = getattr(node, self.left_attr)
+            filters['%s__lt' % self.left_attr] = getattr(node, self.right_attr)
+        if min_depth is not None:
+            filters['%s__gte' % self.level_attr] = level + min_depth
+        if max_depth is not None:
+            filters['%s__lte' % self.level_attr] = level + max_depth
+        return self.filter(**filters)
+
+    def get_siblings_window(self, node, size, include_self=False):
+        """
+        Creates a ``QuerySet`` containing up to ``size`` siblings of
+        ``node`` on either side of it, in tree order. Root nodes are
+        considered to be siblings of other root nodes.
+
+        If ``include_self`` is ``True``, the ``QuerySet`` will also
+        include ``node`` itself.
+
+        The boundaries of the window are found using subqueries, so only
+        one query is required however many siblings ``node`` has.
+        """
+        if size <= 0:
+            if include_self:
+                return self.filter(pk=node.pk)
+            return self.none()
+
+        opts = self.model._meta
+        parent_column = qn(opts.get_field(self.parent_attr).column)
+        parent_id = getattr(node, '%s_id' % self.parent_attr)
+        if parent_id is None:
+            order_attr = self.tree_id_attr
+            siblings = '%s IS NULL' % parent_column
+            siblings_params = []
+            filters = {'%s__isnull' % self.parent_attr: True}
+        else:
+            order_attr = self.left_attr
+            siblings = '%s = %%s' % parent_column
+            siblings_params = [parent_id]
+            filters = {self.parent_attr: parent_id}
+        value = getattr(node, order_attr)
+        clause = SIBLINGS_WINDOW_WHERE % {
+            'mptt_table': qn(opts.db_table),
+            'order': qn(opts.get_field(order_attr).column),
+            'siblings': siblings,
+        }
+        params = (siblings_params + [value, size - 1]) * 2
+        queryset = self.filter(**filters).extra(where=[clause], params=params)
+        if not include_self:
+            queryset = queryset.exclude(pk=node.pk)
+        return queryset
+
+    def get_operation_round_trips(self):
+        """
+        Returns the number of raw SQL statements executed by the last
+        insertion, move, deletion or path update performed on trees
+        managed by this manager in the current thread.
+        """
+        return getattr(_operations, 'round_trips', {}).get(
+            self.model._meta.db_table, 0)
+
+    def get_tree_version(self):
+        """
+        Returns a number which changes whenever trees managed by this
+        manager are written to through it or through their nodes'
+        ``save()`` and ``delete()`` methods in this process.
+        """
+        return _tree_versions.get(self.model._meta.db_table, 0)
+
+    def get_shared_tree_version(self):
+        """
+        Returns a token which changes whenever trees managed by this
+        manager are written to through it or through their nodes'
+        ``save()`` and ``delete()`` methods in any process using the
+        same cache backend.
+        """
+        db_table = self.model._meta.db_table
+        version = cache.get(SHARED_TREE_VERSION_KEY % db_table)
+        if version is None:
+            version = _reset_shared_tree_version(db_table)
+        return version
 
     def get_query_set(self):
         """
@@ -104,9 +441,10 @@ class TreeManager(models.Manager):
         such a way that that root nodes appear in tree id order and
         their subtrees appear in depth-first order.
         """
-        return super(TreeManager, self).get_query_set().order_by(
+        return TreeQuerySet(self.model).order_by(
             self.tree_id_attr, self.left_attr)
 
+    @_tree_operation
     def insert_node(self, node, target, position='last-child',
                     commit=False):
         """
@@ -163,10 +501,30 @@ class TreeManager(models.Manager):
             setattr(node, self.tree_id_attr, tree_id)
             setattr(node, self.parent_attr, parent)
 
+        if self.model._meta.path_field:
+            setattr(node, self.model._meta.path_field,
+                    self._get_path(node, getattr(node, self.parent_attr)))
+
+        transaction.commit_unless_managed()
+        self._bump_tree_version()
         if commit:
             node.save()
         return node
 
+    def leaf_nodes(self, tree_id=None):
+        """
+        Creates a ``QuerySet`` containing leaf nodes, optionally
+        restricted to the tree with the given id.
+
+        Leaf nodes are identified by their right edge indicator being
+        one greater than their left, so no joins are required.
+        """
+        filters = {self.right_attr: F(self.left_attr) + 1}
+        if tree_id is not None:
+            filters[self.tree_id_attr] = tree_id
+        return self.filter(**filters)
+
+    @_tree_operation
     def move_node(self, node, target, position='last-child'):
         """
         Moves ``node`` relative to a given ``target`` node as specified
@@ -196,7 +554,11 @@ class TreeManager(models.Manager):
                 self._move_root_node(node, target, position)
             else:
                 self._move_child_node(node, target, position)
+        if self.model._meta.path_field:
+            self._update_path(node)
         transaction.commit_unless_managed()
+        self._bump_tree_version()
+        node_moved.send(sender=self.model, instance=node)
 
     def root_node(self, tree_id):
         """
@@ -213,6 +575,17 @@ class TreeManager(models.Manager):
         """
         return self.filter(**{'%s__isnull' % self.parent_attr: True})
 
+    def _bump_tree_version(self):
+        """
+        Changes the tree version and shared tree version for the model
+        being managed, marking anything cached from its trees as stale.
+        """
+        db_table = self.model._meta.db_table
+        _tree_versions[db_table] = _tree_version_counter.next()
+        _reset_shared_tree_version(db_table)
+        if transaction.is_managed():
+            _get_pending_shared_versions().add(db_table)
+
     def _calculate_inter_tree_move_values(self, node, target, position):
         """
         Calculates values required when moving ``node`` relative to
@@ -244,6 +617,7 @@ class TreeManager(models.Manager):
         left_right_change = left - space_target - 1
         return space_target, level_change, left_right_change, parent
 
+    @_tree_operation
     def _close_gap(self, size, target, tree_id):
         """
         Closes a gap of a certain ``size`` after the given ``target``
@@ -264,7 +638,7 @@ class TreeManager(models.Manager):
         greater than ``target_tree_id``.
         """
         opts = self.model._meta
-        cursor = connection.cursor()
+        cursor = self._get_cursor()
         cursor.execute("""
         UPDATE %(table)s
         SET %(tree_id)s = %(tree_id)s + 1
@@ -273,13 +647,108 @@ class TreeManager(models.Manager):
             'tree_id': qn(opts.get_field(self.tree_id_attr).column),
         }, [target_tree_id])
 
+    def _get_cursor(self):
+        """
+        Returns a cursor for executing the raw SQL used to maintain the
+        trees of the model being managed.
+
+        Every raw statement issued by this manager goes through here, so
+        this is the one place to change which database they are sent to.
+        During a tree operation, the same cursor is returned each time.
+        """
+        if not getattr(_operations, 'depth', 0):
+            return connection.cursor()
+        if _operations.cursor is None:
+            _operations.cursor = _CountingCursor(connection.cursor())
+        return _operations.cursor
+
+    def _get_path(self, node, parent):
+        """
+        Calculates the value of the path field for ``node`` when it has
+        the given ``parent``.
+        """
+        opts = self.model._meta
+        source = unicode(getattr(node, opts.path_source_field))
+        if parent is None:
+            return source
+        return u'%s%s%s' % (getattr(parent, opts.path_field),
+                            opts.path_separator, source)
+
+    def _get_related_count_subquery(self, rel_model, rel_field, cumulative):
+        """
+        Creates a subquery which counts the instances of ``rel_model``
+        related through ``rel_field`` to each row of this manager's
+        ``Model`` class, optionally including those related to the
+        row's descendants if ``cumulative`` is ``True``.
+        """
+        opts = self.model._meta
+        if cumulative and self._uses_recursive_queries():
+            subquery = RECURSIVE_CUMULATIVE_COUNT_SUBQUERY % {
+                'rel_table': qn(rel_model._meta.db_table),
+                'mptt_fk': qn(rel_model._meta.get_field(rel_field).column),
+                'mptt_table': qn(opts.db_table),
+                'mptt_pk': qn(opts.pk.column),
+                'parent': qn(opts.get_field(self.parent_attr).column),
+            }
+        elif cumulative:
+            subquery = CUMULATIVE_COUNT_SUBQUERY % {
+                'rel_table': qn(rel_model._meta.db_table),
+                'mptt_fk': qn(rel_model._meta.get_field(rel_field).column),
+                'mptt_table': qn(opts.db_table),
+                'mptt_pk': qn(opts.pk.column),
+                'tree_id': qn(opts.get_field(self.tree_id_attr).column),
+                'left': qn(opts.get_field(self.left_attr).column),
+                'right': qn(opts.get_field(self.right_attr).column),
+            }
+        else:
+            subquery = COUNT_SUBQUERY % {
+                'rel_table': qn(rel_model._meta.db_table),
+                'mptt_fk': qn(rel_model._meta.get_field(rel_field).column),
+                'mptt_table': qn(opts.db_table),
+                'mptt_pk': qn(opts.pk.column),
+            }
+        return subquery
+
+    def _get_recursive_queryset(self, queryset, where, params, **clauses):
+        """
+        Restricts ``queryset`` by one of the recursive common table
+        expression ``where`` clauses used by the ``'recursive'`` query
+        strategy, which follow the parent field rather than relying on
+        the left and right edge indicators.
+
+        Any optional ``clauses`` the ``where`` clause accepts which are
+        not given will be left empty.
+        """
+        opts = self.model._meta
+        substitutions = {
+            'mptt_table': qn(opts.db_table),
+            'mptt_pk': qn(opts.pk.column),
+            'parent': qn(opts.get_field(self.parent_attr).column),
+            'include_self': '',
+            'min_depth': '',
+            'max_depth': '',
+        }
+        substitutions.update(clauses)
+        return queryset.extra(where=[where % substitutions], params=params)
+
+    def _uses_recursive_queries(self):
+        """
+        Returns ``True`` if the ``query_strategy`` tree option of the
+        model being managed is ``'recursive'`` and ``False`` if it is
+        ``'nested_set'``, raising a ``ValueError`` for anything else.
+        """
+        query_strategy = self.model._meta.query_strategy
+        if query_strategy not in ('nested_set', 'recursive'):
+            raise ValueError(_('An invalid query strategy was given: %s.') % query_strategy)
+        return query_strategy == 'recursive'
+
     def _get_next_tree_id(self):
         """
         Determines the next largest unused tree id for the tree managed
         by this manager.
         """
         opts = self.model._meta
-        cursor = connection.cursor()
+        cursor = self._get_cursor()
         cursor.execute('SELECT MAX(%s) FROM %s' % (
             qn(opts.get_field(self.tree_id_attr).column),
             qn(opts.db_table)))
@@ -293,6 +762,10 @@ class TreeManager(models.Manager):
         changes being applied to ``node`` and its descendants, closing
         the gap left by moving ``node`` as it does so.
 
+        Only rows whose right edge indicator is at or after ``node``'s
+        left edge indicator are updated, as nodes which end before it
+        are unaffected by the move.
+
         If ``parent_pk`` is ``None``, this indicates that ``node`` is
         being moved to a brand new tree as its root node, and will thus
         have its parent field set to ``NULL``. Otherwise, ``node`` will
@@ -325,7 +798,8 @@ class TreeManager(models.Manager):
                 WHEN %(pk)s = %%s
                     THEN %(new_parent)s
                 ELSE %(parent)s END
-        WHERE %(tree_id)s = %%s""" % {
+        WHERE %(tree_id)s = %%s
+          AND %(right)s >= %%s""" % {
             'table': qn(opts.db_table),
             'level': qn(opts.get_field(self.level_attr).column),
             'left': qn(opts.get_field(self.left_attr).column),
@@ -348,11 +822,11 @@ class TreeManager(models.Manager):
             left, right, left_right_change,
             gap_target_left, gap_size,
             node.pk,
-            getattr(node, self.tree_id_attr)
+            getattr(node, self.tree_id_attr), left,
         ]
         if parent_pk is not None:
-            params.insert(-1, parent_pk)
-        cursor = connection.cursor()
+            params.insert(-2, parent_pk)
+        cursor = self._get_cursor()
         cursor.execute(inter_tree_move_query, params)
 
     def _make_child_root_node(self, node, new_tree_id=None):
@@ -461,11 +935,52 @@ class TreeManager(models.Manager):
                 'table': qn(opts.db_table),
                 'tree_id': qn(opts.get_field(self.tree_id_attr).column),
             }
-            cursor = connection.cursor()
+            cursor = self._get_cursor()
             cursor.execute(root_sibling_query, [tree_id, new_tree_id, shift,
                                                 lower_bound, upper_bound])
             setattr(node, self.tree_id_attr, new_tree_id)
 
+    @_tree_operation
+    def _update_path(self, node, old_path=None):
+        """
+        Brings the path field of ``node`` and all of its descendants up
+        to date after ``node`` has been moved or its path source field
+        has changed, replacing the old path prefix with the new one in
+        a single query.
+
+        If ``old_path`` is not given, the value currently held by
+        ``node`` is assumed to be the one stored in the database.
+
+        ``node`` will be modified to reflect its new path.
+        """
+        opts = self.model._meta
+        if old_path is None:
+            old_path = getattr(node, opts.path_field)
+        new_path = self._get_path(node, getattr(node, self.parent_attr))
+        if new_path == old_path:
+            return
+
+        if settings.DATABASE_ENGINE == 'mysql':
+            concatenation = 'CONCAT(%%s, SUBSTR(%(path)s, %%s))'
+        else:
+            concatenation = '%%s || SUBSTR(%(path)s, %%s)'
+        path_query = ("""
+        UPDATE %(table)s
+        SET %(path)s = """ + concatenation + """
+        WHERE %(tree_id)s = %%s
+          AND %(left)s >= %%s AND %(left)s <= %%s""") % {
+            'table': qn(opts.db_table),
+            'path': qn(opts.get_field(opts.path_field).column),
+            'tree_id': qn(opts.get_field(self.tree_id_attr).column),
+            'left': qn(opts.get_field(self.left_attr).column),
+        }
+        cursor = self._get_cursor()
+        cursor.execute(path_query, [new_path, len(old_path) + 1,
+                                    getattr(node, self.tree_id_attr),
+                                    getattr(node, self.left_attr),
+                                    getattr(node, self.right_attr)])
+        setattr(node, opts.path_field, new_path)
+
     def _manage_space(self, size, target, tree_id):
         """
         Manages spaces in the tree identified by ``tree_id`` by changing
@@ -490,7 +1005,7 @@ class TreeManager(models.Manager):
             'right': qn(opts.get_field(self.right_attr).column),
             'tree_id': qn(opts.get_field(self.tree_id_attr).column),
         }
-        cursor = connection.cursor()
+        cursor = self._get_cursor()
         cursor.execute(space_query, [target, size, target, size, tree_id,
                                      target, target])
 
@@ -551,6 +1066,10 @@ class TreeManager(models.Manager):
         Moves child node ``node`` within its current tree relative to
         the given ``target`` node as specified by ``position``.
 
+        Only rows with an edge indicator between the lowest and highest
+        edge indicators of ``node``'s old and new positions are updated,
+        as nodes outside of that window are unaffected by the move.
+
         ``node`` will be modified to reflect its new tree state in the
         database.
         """
@@ -642,7 +1161,9 @@ class TreeManager(models.Manager):
                 WHEN %(pk)s = %%s
                   THEN %%s
                 ELSE %(parent)s END
-        WHERE %(tree_id)s = %%s""" % {
+        WHERE %(tree_id)s = %%s
+          AND (%(left)s >= %%s AND %(left)s <= %%s
+               OR %(right)s >= %%s AND %(right)s <= %%s)""" % {
             'table': qn(opts.db_table),
             'level': qn(opts.get_field(self.level_attr).column),
             'left': qn(opts.get_field(self.left_attr).column),
@@ -652,7 +1173,7 @@ class TreeManager(models.Manager):
             'tree_id': qn(opts.get_field(self.tree_id_attr).column),
         }
 
-        cursor = connection.cursor()
+        cursor = self._get_cursor()
         cursor.execute(move_subtree_query, [
             left, right, level_change,
             left, right, left_right_change,
@@ -660,7 +1181,9 @@ class TreeManager(models.Manager):
             left, right, left_right_change,
             left_boundary, right_boundary, gap_size,
             node.pk, parent.pk,
-            tree_id])
+            tree_id,
+            left_boundary, right_boundary,
+            left_boundary, right_boundary])
 
         # Update the node to be consistent with the updated
         # tree in the database.
@@ -718,7 +1241,7 @@ class TreeManager(models.Manager):
             'parent': qn(opts.get_field(self.parent_attr).column),
             'pk': qn(opts.pk.column),
         }
-        cursor = connection.cursor()
+        cursor = self._get_cursor()
         cursor.execute(move_tree_query, [level_change, left_right_change,
             left_right_change, new_tree_id, node.pk, parent.pk, left, right,
             tree_id])
@@ -730,3 +1253,38 @@ class TreeManager(models.Manager):
         setattr(node, self.level_attr, level - level_change)
         setattr(node, self.tree_id_attr, new_tree_id)
         setattr(node, self.parent_attr, parent)
+
+def _reset_shared_tree_version(db_table):
+    """
+    Sets a new shared tree version for the given table, returning it.
+    """
+    version = '%x.%x' % (int(time.time() * 1000000),
+                         random.getrandbits(64))
+    cache.set(SHARED_TREE_VERSION_KEY % db_table, version)
+    return version
+
+def _get_pending_shared_versions():
+    """
+    Returns the set of tables written to during the current thread's
+    managed transaction.
+    """
+    tables = getattr(_pending_shared_versions, 'tables', None)
+    if tables is None:
+        tables = _pending_shared_versions.tables = set()
+    return tables
+
+def reset_pending_tree_versions(**kwargs):
+    """
+    Sets new shared tree versions for tables which were written to
+    during the current thread's managed transaction.
+
+    This is done when each request finishes, after
+    ``TransactionMiddleware`` has committed its transaction. Code which
+    manages its own transactions outside of requests should call this
+    once it has committed.
+    """
+    tables = _get_pending_shared_versions()
+    while tables:
+        _reset_shared_tree_version(tables.pop())
+
+request_finished.connect(reset_pending_tree_versions)
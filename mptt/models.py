@@ -4,11 +4,13 @@ Preorder Tree Traversal.
 """
 
 import copy
-from django.db import models
-from django.db.models import base
+from django.db import connection, models, transaction, DatabaseError
+from django.db.backends.util import truncate_name
+from django.db.models import base, signals
+from django.db.models import F
 from django.db.models.query import Q
-from django.utils.datastructures import SortedDict
 from mptt.managers import TreeManager
+from mptt.utils import _get_cached_queryset, _get_request_cache
 import operator
 
 def _insertion_target_filters(node, order_insertion_by):
@@ -69,6 +71,66 @@ def _get_ordered_insertion_target(node, parent):
             pass
     return right_sibling
 
+def _get_composite_indexes(model):
+    """
+    Returns a list of lists of column names for the composite indexes
+    requested by the ``composite_indexes`` tree option of ``model``.
+
+    A value of ``True`` requests the default ``(tree_id, left)`` and
+    ``(tree_id, right)`` indexes; otherwise the option is taken to be a
+    list of lists of field names.
+
+    Indexes including fields which aren't in ``model``'s own table, as
+    is the case for the tree fields of a concrete subclass of another
+    model, are left out.
+    """
+    opts = model._meta
+    indexes = opts.composite_indexes
+    if not indexes:
+        return []
+    if indexes is True:
+        indexes = [[opts.tree_id_attr, opts.left_attr],
+                   [opts.tree_id_attr, opts.right_attr]]
+    fields = [[opts.get_field(attr) for attr in attrs] for attrs in indexes]
+    return [[field.column for field in index_fields]
+            for index_fields in fields
+            if not [f for f in index_fields if f not in opts.local_fields]]
+
+def _create_composite_indexes(sender, created_models, verbosity=1, **kwargs):
+    """
+    Creates composite indexes for any newly created tables belonging to
+    models which have the ``composite_indexes`` tree option set, since
+    Django can only create single column indexes itself.
+
+    The ``flush`` command sends the signal with every model, so indexes
+    which can't be created because they already exist are skipped.
+    """
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for model in created_models:
+        # The signal is sent once per installed application, with every
+        # newly created model, so only deal with the sender's models.
+        if (not isinstance(model, ModelBase) or model._meta.proxy or
+            models.get_app(model._meta.app_label) is not sender):
+            continue
+        table = model._meta.db_table
+        for columns in _get_composite_indexes(model):
+            index_name = truncate_name('%s_%s' % (table, '_'.join(columns)),
+                                       connection.ops.max_name_length())
+            sid = transaction.savepoint()
+            try:
+                cursor.execute('CREATE INDEX %s ON %s (%s)' % (
+                    qn(index_name), qn(table),
+                    ', '.join([qn(column) for column in columns])))
+            except DatabaseError:
+                transaction.savepoint_rollback(sid)
+                continue
+            transaction.savepoint_commit(sid)
+            if verbosity >= 2:
+                print 'Installed composite index %s for %s model' % (
+                    index_name, model._meta.object_name)
+    transaction.commit_unless_managed()
+
 
 class ModelBase(base.ModelBase):
     def __init__(cls, name, bases, attrs):
@@ -81,6 +143,13 @@ class ModelBase(base.ModelBase):
             'level_attr': 'level',
             'tree_manager_attr': 'tree',
             'order_insertion_by': None,
+            'composite_indexes': None,
+            'query_strategy': 'nested_set',
+            'path_field': None,
+            'path_source_field': 'slug',
+            'path_separator': '/',
+            'partial_tree_loading': False,
+            'partial_tree_depth': None,
         }
         concrete_parent = False
         for base in bases:
@@ -188,8 +257,8 @@ class Model(models.Model):
             # TODO Is it possible to track the original parent so we
             #      don't have to look it up again on each save after the
             #      first?
-            old_parent = getattr(self._default_manager.get(pk=self.pk),
-                                 opts.parent_attr)
+            old_node = self._default_manager.get(pk=self.pk)
+            old_parent = getattr(old_node, opts.parent_attr)
             if parent != old_parent:
                 setattr(self, opts.parent_attr, old_parent)
                 try:
@@ -207,7 +276,13 @@ class Model(models.Model):
                     # Make sure the self's new parent is always
                     # restored on the way out in case of errors.
                     setattr(self, opts.parent_attr, parent)
+            elif (opts.path_field and
+                  getattr(self, opts.path_source_field) !=
+                  getattr(old_node, opts.path_source_field)):
+                self._tree_manager._update_path(
+                    self, getattr(old_node, opts.path_field))
         super(Model, self).save(*args, **kwargs)
+        self._tree_manager._bump_tree_version()
 
     def delete(self, *args, **kwargs):
         opts = self._meta
@@ -217,6 +292,51 @@ class Model(models.Model):
         tree_id = getattr(self, opts.tree_id_attr)
         self._tree_manager._close_gap(tree_width, target_right, tree_id)
         super(Model, self).delete(*args, **kwargs)
+        self._tree_manager._bump_tree_version()
+
+    def __reduce__(self):
+        """
+        Leaves the traversal cache out when pickling, as tree versions
+        are only meaningful within the process which created them.
+        """
+        unpickle, args, data = super(Model, self).__reduce__()
+        if '_traversal_cache' in data:
+            data = data.copy()
+            del data['_traversal_cache']
+        return unpickle, args, data
+
+    def _get_traversal_cache(self):
+        """
+        Returns a ``dict`` in which the results of traversal methods may
+        be cached on this model instance.
+
+        The cache is emptied whenever the tree version changes, which
+        happens when any node of this model is saved, moved, inserted or
+        deleted, including this one.
+        """
+        version = self._tree_manager.get_tree_version()
+        cache = self.__dict__.get('_traversal_cache')
+        if cache is None or cache[0] != version:
+            cache = self._traversal_cache = (version, {})
+        return cache[1]
+
+    def _get_cached_parents(self):
+        """
+        Returns a list of this model instance's ancestors, immediate
+        parent first, if every parent up to the root node has already
+        been loaded (for example, by ``select_related``) and is cached
+        on its child, otherwise returns ``None``.
+        """
+        opts = self._meta
+        cache_name = opts.get_field(opts.parent_attr).get_cache_name()
+        parents = []
+        node = self
+        while getattr(node, '%s_id' % opts.parent_attr) is not None:
+            node = getattr(node, cache_name, None)
+            if node is None:
+                return None
+            parents.append(node)
+        return parents
     
     def get_ancestors(self, ascending=False):
         """
@@ -227,16 +347,23 @@ class Model(models.Model):
         immediate parent last); passing ``True`` for the ``ascending``
         argument will reverse the ordering (immediate parent first, root
         ancestor last).
-        """
-        if self.is_root_node():
-            return self._tree_manager.none()
 
-        opts = self._meta
-        return self._default_manager.filter(**{
-            '%s__lt' % opts.left_attr: getattr(self, opts.left_attr),
-            '%s__gt' % opts.right_attr: getattr(self, opts.right_attr),
-            opts.tree_id_attr: getattr(self, opts.tree_id_attr),
-        }).order_by('%s%s' % ({True: '-', False: ''}[ascending], opts.left_attr))
+        The ``QuerySet`` is cached on this model instance until the tree
+        changes. If every parent up to the root node has already been
+        loaded, it will be filled from them without a database query.
+        """
+        cache = self._get_traversal_cache()
+        key = ('ancestors', ascending)
+        if key not in cache:
+            ancestors = self._tree_manager.get_ancestors(self, ascending,
+                queryset=self._default_manager.all())
+            parents = self._get_cached_parents()
+            if parents is not None and not self.is_root_node():
+                if not ascending:
+                    parents.reverse()
+                ancestors = _get_cached_queryset(ancestors, parents)
+            cache[key] = ancestors
+        return cache[key]
 
     def get_children(self):
         """
@@ -247,34 +374,42 @@ class Model(models.Model):
         provided by the ORM to the instance's children is that a
         database query can be avoided in the case where the instance is
         a leaf node (it has no children).
+
+        The ``QuerySet`` is cached on this model instance until the tree
+        changes.
         """
         if self.is_leaf_node():
             return self._tree_manager.none()
 
-        return self._tree_manager.filter(**{
-            self._meta.parent_attr: self,
-        })
+        cache = self._get_traversal_cache()
+        if 'children' not in cache:
+            cache['children'] = self._tree_manager.filter(**{
+                self._meta.parent_attr: self,
+            })
+        return cache['children']
 
-    def get_descendants(self, include_self=False):
+    def get_descendants(self, include_self=False, min_depth=None,
+                        max_depth=None):
         """
         Creates a ``QuerySet`` containing descendants of this model
         instance, in tree order.
 
         If ``include_self`` is ``True``, the ``QuerySet`` will also
         include this model instance.
-        """
-        if not include_self and self.is_leaf_node():
-            return self._tree_manager.none()
 
-        opts = self._meta
-        filters = {opts.tree_id_attr: getattr(self, opts.tree_id_attr)}
-        if include_self:
-            filters['%s__range' % opts.left_attr] = (getattr(self, opts.left_attr),
-                                                     getattr(self, opts.right_attr))
-        else:
-            filters['%s__gt' % opts.left_attr] = getattr(self, opts.left_attr)
-            filters['%s__lt' % opts.left_attr] = getattr(self, opts.right_attr)
-        return self._tree_manager.filter(**filters)
+        If ``min_depth`` or ``max_depth`` are given, only descendants
+        which are at least or at most that many levels below this model
+        instance will be included; its children are one level below it.
+
+        The ``QuerySet`` is cached on this model instance until the tree
+        changes.
+        """
+        cache = self._get_traversal_cache()
+        key = ('descendants', include_self, min_depth, max_depth)
+        if key not in cache:
+            cache[key] = self._tree_manager.get_descendants(
+                self, include_self, min_depth, max_depth)
+        return cache[key]
 
     def get_descendant_count(self):
         """
@@ -283,26 +418,45 @@ class Model(models.Model):
         return (getattr(self, self._meta.right_attr) -
                 getattr(self, self._meta.left_attr) - 1) / 2
 
+    def get_leafnodes(self, include_self=False):
+        """
+        Creates a ``QuerySet`` containing leaf nodes which are
+        descendants of this model instance, in tree order.
+
+        If ``include_self`` is ``True``, the ``QuerySet`` will also
+        include this model instance if it is a leaf node.
+        """
+        opts = self._meta
+        return self.get_descendants(include_self).filter(**{
+            opts.right_attr: F(opts.left_attr) + 1,
+        })
+
     def get_next_sibling(self):
         """
         Returns this model instance's next sibling in the tree, or
         ``None`` if it doesn't have a next sibling.
+
+        A child node's next sibling is the node whose left edge
+        indicator immediately follows this model instance's right edge
+        indicator, while root nodes always have a left edge indicator of
+        ``1``, so both can be looked up using the tree fields alone.
         """
         opts = self._meta
         if self.is_root_node():
             filters = {
-                '%s__isnull' % opts.parent_attr: True,
+                opts.left_attr: 1,
                 '%s__gt' % opts.tree_id_attr: getattr(self, opts.tree_id_attr),
             }
         else:
             filters = {
-                 opts.parent_attr: getattr(self, '%s_id' % opts.parent_attr),
-                '%s__gt' % opts.left_attr: getattr(self, opts.right_attr),
+                opts.tree_id_attr: getattr(self, opts.tree_id_attr),
+                opts.left_attr: getattr(self, opts.right_attr) + 1,
             }
 
         sibling = None
         try:
-            sibling = self._tree_manager.filter(**filters)[0]
+            sibling = self._tree_manager.filter(**filters).order_by(
+                opts.tree_id_attr)[0]
         except IndexError:
             pass
         return sibling
@@ -315,20 +469,19 @@ class Model(models.Model):
         opts = self._meta
         if self.is_root_node():
             filters = {
-                '%s__isnull' % opts.parent_attr: True,
+                opts.left_attr: 1,
                 '%s__lt' % opts.tree_id_attr: getattr(self, opts.tree_id_attr),
             }
-            order_by = '-%s' % opts.tree_id_attr
         else:
             filters = {
-                 opts.parent_attr: getattr(self, '%s_id' % opts.parent_attr),
-                '%s__lt' % opts.right_attr: getattr(self, opts.left_attr),
+                opts.tree_id_attr: getattr(self, opts.tree_id_attr),
+                opts.right_attr: getattr(self, opts.left_attr) - 1,
             }
-            order_by = '-%s' % opts.right_attr
 
         sibling = None
         try:
-            sibling = self._tree_manager.filter(**filters).order_by(order_by)[0]
+            sibling = self._tree_manager.filter(**filters).order_by(
+                '-%s' % opts.tree_id_attr)[0]
         except IndexError:
             pass
         return sibling
@@ -336,15 +489,25 @@ class Model(models.Model):
     def get_root(self):
         """
         Returns the root node of this model instance's tree.
+
+        The root node is cached on this model instance until the tree
+        changes.
         """
         if self.is_root_node():
             return self
 
-        opts = self._meta
-        return self._default_manager.get(**{
-            opts.tree_id_attr: getattr(self, opts.tree_id_attr),
-            '%s__isnull' % opts.parent_attr: True,
-        })
+        cache = self._get_traversal_cache()
+        if 'root' not in cache:
+            parents = self._get_cached_parents()
+            if parents is not None:
+                cache['root'] = parents[-1]
+            else:
+                opts = self._meta
+                cache['root'] = self._default_manager.get(**{
+                    opts.tree_id_attr: getattr(self, opts.tree_id_attr),
+                    '%s__isnull' % opts.parent_attr: True,
+                })
+        return cache['root']
 
     def get_siblings(self, include_self=False):
         """
@@ -365,6 +528,17 @@ class Model(models.Model):
             queryset = queryset.exclude(pk=self.pk)
         return queryset
 
+    def get_siblings_window(self, size, include_self=False):
+        """
+        Creates a ``QuerySet`` containing up to ``size`` siblings of
+        this model instance on either side of it, in tree order.
+
+        If ``include_self`` is ``True``, the ``QuerySet`` will also
+        include this model instance.
+        """
+        return self._tree_manager.get_siblings_window(self, size,
+                                                      include_self)
+
     def insert_at(self, target, position='first-child', commit=False):
         """
         Convenience method for calling ``TreeManager.insert_node`` with this
@@ -379,6 +553,34 @@ class Model(models.Model):
         """
         return not self.is_root_node()
 
+    def is_ancestor_of(self, other, include_self=False):
+        """
+        Returns ``True`` if this model instance is an ancestor of
+        ``other``, ``False`` otherwise.
+
+        If ``include_self`` is ``True``, this will also be ``True`` if
+        ``other`` is this model instance.
+        """
+        return other.is_descendant_of(self, include_self)
+
+    def is_descendant_of(self, other, include_self=False):
+        """
+        Returns ``True`` if this model instance is a descendant of
+        ``other``, ``False`` otherwise. As only the tree fields of both
+        are compared, this does not incur any database access.
+
+        If ``include_self`` is ``True``, this will also be ``True`` if
+        ``other`` is this model instance.
+        """
+        opts = self._meta
+        if getattr(self, opts.tree_id_attr) != getattr(other, opts.tree_id_attr):
+            return False
+        left = getattr(self, opts.left_attr)
+        other_left = getattr(other, opts.left_attr)
+        if include_self and left == other_left:
+            return True
+        return other_left < left < getattr(other, opts.right_attr)
+
     def is_leaf_node(self):
         """
         Returns ``True`` if this model instance is a leaf node (it has no
@@ -405,113 +607,227 @@ class LoadTreeModel(Model):
     """
     A subclass of Model that loads the entire tree whenever a method is called
     that hits the database. The tree can then be traversed in memory.
+
+    Loaded trees are shared by every instance of the same tree in the
+    current thread until the tree version changes or the current request
+    finishes, so instances loaded by different queries don't each load
+    the tree again.
+
+    If the ``partial_tree_loading`` tree option is set, only the
+    ancestors and subtree of a node are loaded, and more of the tree is
+    loaded as traversal reaches nodes whose children haven't been
+    loaded yet.
     """
     class Meta:
         abstract = True
     
-    def __init__(self, *args, **kwargs):
-        super(LoadTreeModel, self).__init__(*args, **kwargs)
-        self._children_cache = None
-    
-    def populate_tree_cache(self):
-        # Cache has already been filled
-        if self._children_cache is not None:
-            return
+    def _get_tree_cache(self):
+        """
+        Returns a ``dict`` of the loaded nodes of this model instance's
+        tree, keyed by primary key, loading the tree if it hasn't been
+        loaded in the current thread or has changed since it was loaded.
+
+        The nodes in the cache are shared, so they shouldn't be modified.
+        """
         opts = self._meta
-        nodes = self._tree_manager.filter(**{
-                    opts.tree_id_attr: getattr(self, opts.tree_id_attr)})
-        node_dict = SortedDict([(n.pk, n) for n in nodes])
-        for node in node_dict.values():
-            if node == self:
-                node = node_dict[node.pk] = self
-            # _children_cache will only be modified up the tree, so initialise
-            # it when we're going down
-            node._children_cache = []
-            # Ensure parent points to our object with the cache
-            parent_id = getattr(node, '%s_id' % opts.parent_attr)
-            if parent_id is not None:
-                setattr(node, opts.parent_attr, node_dict[parent_id])
-                node_dict[parent_id]._children_cache.append(node)
-        
-    def clear_tree_cache(self, relative=False):
+        manager = self._tree_manager
+        tree_id = getattr(self, opts.tree_id_attr)
+        version = manager.get_tree_version()
+        trees = _get_request_cache('trees')
+        cached = trees.get((manager.model, tree_id))
+        if cached is None or cached[0] != version:
+            node_dict = {}
+            if not opts.partial_tree_loading:
+                _link_tree_nodes(node_dict, manager.filter(**{
+                    opts.tree_id_attr: tree_id}))
+            cached = trees[(manager.model, tree_id)] = (version, node_dict)
+        return cached[1]
+
+    def _get_cached_node(self):
+        """
+        Returns the shared copy of this model instance in its tree's
+        cache.
+        """
+        node_dict = self._get_tree_cache()
+        if self.pk not in node_dict:
+            self._load_subtree(node_dict, include_ancestors=True)
+        return node_dict[self.pk]
+
+    def _get_cached_children(self):
+        """
+        Returns the list of children of this shared copy of a model
+        instance, loading its subtree first if its children haven't
+        been loaded yet.
+        """
         if self._children_cache is None:
-            return
-        if relative:
-            node = self
-        else:
-            node = self.get_root()
-        for c in node._children_cache:
-            c.clear_tree_cache(relative=True)
-        node._children_cache = None
-    
-    def save(self, *args, **kwargs):
-        self.clear_tree_cache()
-        super(LoadTreeModel, self).save(*args, **kwargs)
+            node_dict = self._get_tree_cache()
+            self._load_subtree(node_dict)
+            return node_dict[self.pk]._children_cache
+        return self._children_cache
+
+    def _load_subtree(self, node_dict, include_ancestors=False):
+        """
+        Loads this model instance's subtree into ``node_dict``, down to
+        the depth given by the ``partial_tree_depth`` tree option, along
+        with its ancestors if ``include_ancestors`` is ``True``.
+        """
+        opts = self._meta
+        left = getattr(self, opts.left_attr)
+        right = getattr(self, opts.right_attr)
+        subtree = Q(**{'%s__range' % opts.left_attr: (left, right)})
+        max_level = None
+        if opts.partial_tree_depth is not None:
+            max_level = getattr(self, opts.level_attr) + opts.partial_tree_depth
+            subtree &= Q(**{'%s__lte' % opts.level_attr: max_level})
+        if include_ancestors:
+            subtree |= Q(**{
+                '%s__lt' % opts.left_attr: left,
+                '%s__gt' % opts.right_attr: right,
+            })
+        nodes = self._tree_manager.filter(subtree, **{
+            opts.tree_id_attr: getattr(self, opts.tree_id_attr)})
+        _link_tree_nodes(node_dict, nodes, self, max_level)
+
+    def populate_tree_cache(self):
+        self._get_cached_node()
+        
+    def clear_tree_cache(self):
+        opts = self._meta
+        trees = _get_request_cache('trees')
+        trees.pop((self._tree_manager.model,
+                   getattr(self, opts.tree_id_attr)), None)
     
     def get_ancestors(self, ascending=False):
-        self.populate_tree_cache()
+        parent_attr = self._meta.parent_attr
         ancestors = []
-        node = self
-        while node.parent is not None:
-            ancestors.append(node.parent)
-            node = node.parent
+        node = getattr(self._get_cached_node(), parent_attr)
+        while node is not None:
+            ancestors.append(node)
+            node = getattr(node, parent_attr)
         if not ascending:
             ancestors.reverse()
         return ancestors
     
     def get_children(self):
-        self.populate_tree_cache()
-        return self._children_cache[:]
+        return self._get_cached_node()._get_cached_children()[:]
     
-    def get_descendants(self, include_self=False):
-        self.populate_tree_cache()
-        descendants = []
-        if include_self:
-            descendants.append(self)
-        for c in self._children_cache:
-            descendants.extend(c.get_descendants(include_self=True))
-        return descendants
+    def get_descendants(self, include_self=False, min_depth=None,
+                        max_depth=None):
+        return list(self.iter_descendants(include_self, min_depth,
+                                          max_depth))
+    
+    def iter_descendants(self, include_self=False, min_depth=None,
+                         max_depth=None):
+        """
+        Yields the descendants of this model instance in tree order,
+        optionally starting with this model instance itself and limited
+        by depth as for ``get_descendants()``.
+
+        The tree is walked using a stack of iterators over each level's
+        children rather than by recursion, so the depth of the tree
+        isn't limited by Python's recursion limit and descendants can be
+        consumed lazily.
+        """
+        if include_self and not min_depth:
+            yield self
+        if max_depth is not None and max_depth <= 0:
+            return
+        stack = [iter(self._get_cached_node()._get_cached_children())]
+        while stack:
+            for node in stack[-1]:
+                depth = len(stack)
+                if min_depth is None or depth >= min_depth:
+                    yield node
+                if max_depth is not None and depth >= max_depth:
+                    continue
+                children = node._get_cached_children()
+                if children:
+                    stack.append(iter(children))
+                    break
+            else:
+                stack.pop()
+    
+    def get_leafnodes(self, include_self=False):
+        return [node for node in self.iter_descendants(include_self)
+                if node.is_leaf_node()]
     
     def get_next_sibling(self):
         if self.is_root_node():
             return super(LoadTreeModel, self).get_next_sibling()
-        self.populate_tree_cache()
-        for i, child in enumerate(self.parent._children_cache):
-            if child == self:
-                try:
-                    return self.parent._children_cache[i+1]
-                except IndexError:
-                    return None
+        node = self._get_cached_node()
+        siblings = getattr(node, self._meta.parent_attr)._get_cached_children()
+        try:
+            return siblings[node._sibling_index + 1]
+        except IndexError:
+            return None
     
     def get_previous_sibling(self):
         if self.is_root_node():
             return super(LoadTreeModel, self).get_previous_sibling()
-        self.populate_tree_cache()
-        for i, child in enumerate(self.parent._children_cache):
-            if child == self:
-                if i == 0:
-                    return None
-                return self.parent._children_cache[i-1]
+        node = self._get_cached_node()
+        siblings = getattr(node, self._meta.parent_attr)._get_cached_children()
+        if node._sibling_index == 0:
+            return None
+        return siblings[node._sibling_index - 1]
         
     def get_root(self):
-        self.populate_tree_cache()
-        node = self
-        while node.parent is not None:
-            node = node.parent
+        parent_attr = self._meta.parent_attr
+        node = self._get_cached_node()
+        while getattr(node, parent_attr) is not None:
+            node = getattr(node, parent_attr)
         return node
     
     def get_siblings(self, include_self=False):
         if self.is_root_node():
             return super(LoadTreeModel, self).get_siblings(include_self)
-        self.populate_tree_cache()
-        # get_children copies so we can non-destructively remove below
-        siblings = self.parent.get_children()
+        node = self._get_cached_node()
+        # Copy so we can non-destructively remove below
+        siblings = getattr(node, self._meta.parent_attr)._get_cached_children()[:]
         if not include_self:
-            siblings.remove(self)
+            siblings.remove(node)
         return siblings
-    
-    def move_to(self, target, position='first-child'):
-        self.clear_tree_cache()
-        return super(LoadTreeModel, self).move_to(target, position)
-
 
+def _link_tree_nodes(node_dict, nodes, subtree_root=None, max_level=None):
+    """
+    Adds ``nodes``, which must be in tree order, to ``node_dict``, which
+    is keyed by primary key, linking each of them to its parent and
+    children in ``node_dict``. Nodes already in ``node_dict`` are kept
+    in place of their copies in ``nodes``.
+
+    ``nodes`` must include the parent of every node which isn't already
+    in ``node_dict``, and all the children of each node within
+    ``subtree_root``'s subtree above ``max_level``, which will have
+    their lists of children filled in along with those of leaf nodes.
+    If ``subtree_root`` isn't given, ``nodes`` must be whole trees.
+    """
+    filling = set()
+    for node in nodes:
+        opts = node._meta
+        if node.pk in node_dict:
+            node = node_dict[node.pk]
+        else:
+            node_dict[node.pk] = node
+            # Ensure parent points to our object with the cache
+            parent_id = getattr(node, '%s_id' % opts.parent_attr)
+            if parent_id is not None:
+                setattr(node, opts.parent_attr, node_dict[parent_id])
+            # A list of children is only set when they're all loaded
+            node._children_cache = None
+        if node._children_cache is None and (subtree_root is None or
+                node.is_leaf_node() or (
+                getattr(node, opts.left_attr) >= getattr(subtree_root, opts.left_attr) and
+                getattr(node, opts.right_attr) <= getattr(subtree_root, opts.right_attr) and
+                (max_level is None or getattr(node, opts.level_attr) < max_level))):
+            # _children_cache will only be modified up the tree, so
+            # initialise it when we're going down
+            node._children_cache = []
+            filling.add(node.pk)
+        parent_id = getattr(node, '%s_id' % opts.parent_attr)
+        if parent_id in filling:
+            parent = node_dict[parent_id]
+            # Record the node's position among its siblings so they
+            # can be found without scanning its parent's children
+            node._sibling_index = len(parent._children_cache)
+            parent._children_cache.append(node)
+
+signals.post_syncdb.connect(_create_composite_indexes)
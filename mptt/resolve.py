@@ -0,0 +1,104 @@
+"""
+Resolution of paths made up of node field values (such as slugs) to
+tree nodes, without database access.
+"""
+import sys
+
+from django.db.models import signals
+
+from mptt.signals import node_moved
+
+__all__ = ('PathResolver',)
+
+def _estimate_size(obj):
+    """
+    Roughly estimates the number of bytes used by ``obj``, for Python
+    versions without ``sys.getsizeof``.
+    """
+    if isinstance(obj, basestring):
+        return 40 + len(obj) * (isinstance(obj, unicode) and 4 or 1)
+    if isinstance(obj, (tuple, dict)):
+        return 56 + len(obj) * 24
+    return 24
+
+_getsizeof = getattr(sys, 'getsizeof', None) or _estimate_size
+
+class PathResolver(object):
+    """
+    Resolves paths such as ``'books/sci-fi/dystopian'`` to the primary
+    key of the node they identify, using an in-memory trie built from a
+    single query.
+
+    Each level of the trie is held as a ``(parent pk, field value)``
+    key, so resolving a path takes one dictionary lookup per path part,
+    and moving a node only requires its own entry to be changed, as
+    its descendants are keyed by its primary key, which doesn't change.
+
+    The trie is kept up to date as nodes are saved, moved and deleted
+    in this process. Changes made elsewhere (by other processes, or
+    with ``QuerySet.update``) require ``refresh()`` to be called.
+    """
+    def __init__(self, model, source_field='slug', separator='/'):
+        self.model = model
+        self.source_field = source_field
+        self.separator = separator
+        self._pks = {}
+        self._keys = {}
+        self.refresh()
+        signals.post_save.connect(self._node_saved, sender=model)
+        signals.post_delete.connect(self._node_deleted, sender=model)
+        node_moved.connect(self._node_saved, sender=model)
+
+    def refresh(self):
+        """
+        Rebuilds the trie from the database.
+        """
+        opts = self.model._meta
+        pks = {}
+        keys = {}
+        for pk, parent_pk, value in self.model._tree_manager.values_list(
+            'pk', opts.parent_attr, self.source_field).iterator():
+            key = (parent_pk, value)
+            pks[key] = pk
+            keys[pk] = key
+        self._pks, self._keys = pks, keys
+
+    def resolve(self, path):
+        """
+        Returns the primary key of the node identified by ``path``, or
+        ``None`` if there is no such node. Leading and trailing
+        separators are ignored.
+        """
+        pk = None
+        for part in path.strip(self.separator).split(self.separator):
+            pk = self._pks.get((pk, part))
+            if pk is None:
+                return None
+        return pk
+
+    def memory_usage(self):
+        """
+        Returns an estimate of the number of bytes used by the trie,
+        including the keys and values it holds.
+        """
+        size = _getsizeof(self._pks) + _getsizeof(self._keys)
+        for key, pk in self._pks.iteritems():
+            size += (_getsizeof(key) + _getsizeof(key[0]) +
+                     _getsizeof(key[1]) + _getsizeof(pk))
+        return size
+
+    def _node_saved(self, sender, instance, **kwargs):
+        opts = self.model._meta
+        self._remove(instance.pk)
+        key = (getattr(instance, '%s_id' % opts.parent_attr),
+               getattr(instance, self.source_field))
+        self._pks[key] = instance.pk
+        self._keys[instance.pk] = key
+
+    def _node_deleted(self, sender, instance, **kwargs):
+        self._remove(instance.pk)
+
+    def _remove(self, pk):
+        key = self._keys.pop(pk, None)
+        if key is not None and self._pks.get(key) == pk:
+            del self._pks[key]
@@ -0,0 +1,8 @@
+"""
+Signals sent when the structure of a tree changes.
+"""
+from django.dispatch import Signal
+
+# Sent by ``TreeManager.move_node`` once a node has been moved, with the
+# node's tree fields (and parent) reflecting its new position.
+node_moved = Signal(providing_args=['instance'])
@@ -3,25 +3,42 @@ Template tags for working with lists of model instances which represent
 trees.
 """
 from django import template
+from django.core.cache import cache
 from django.db.models import get_model
 from django.db.models.fields import FieldDoesNotExist
 from django.utils.encoding import force_unicode
+from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext as _
 
-from mptt.utils import tree_item_iterator, drilldown_tree_for_node
+from mptt.utils import tree_item_iterator, drilldown_tree_for_node, \
+    add_tree_paths
 
 register = template.Library()
 
 class FullTreeForModelNode(template.Node):
-    def __init__(self, model, context_var):
+    def __init__(self, model, context_var, cached=False, cache_timeout=None):
         self.model = model
         self.context_var = context_var
+        self.cached = cached
+        self.cache_timeout = cache_timeout
 
     def render(self, context):
         cls = get_model(*self.model.split('.'))
         if cls is None:
             raise template.TemplateSyntaxError(_('full_tree_for_model tag was given an invalid model: %s') % self.model)
-        context[self.context_var] = cls._tree_manager.all()
+        if not self.cached:
+            context[self.context_var] = cls._tree_manager.all()
+            return ''
+        # The shared tree version changes whenever the tree is written
+        # to, so stale trees will never be retrieved.
+        opts = cls._meta
+        key = 'mptt.full_tree.%s.%s.%s' % (opts.app_label, opts.module_name,
+            cls._tree_manager.get_shared_tree_version())
+        nodes = cache.get(key)
+        if nodes is None:
+            nodes = list(cls._tree_manager.all())
+            cache.set(key, nodes, self.cache_timeout)
+        context[self.context_var] = nodes
         return ''
 
 class DrilldownTreeForNodeNode(template.Node):
@@ -51,6 +68,67 @@ class DrilldownTreeForNodeNode(template.Node):
         context[self.context_var] = drilldown_tree_for_node(*args)
         return ''
 
+class DescendantsForNodeNode(template.Node):
+    def __init__(self, node, context_var, max_depth=None):
+        self.node = template.Variable(node)
+        self.context_var = context_var
+        self.max_depth = max_depth
+
+    def render(self, context):
+        # Let any VariableDoesNotExist raised bubble up
+        node = self.node.resolve(context)
+        if self.max_depth is None:
+            context[self.context_var] = node.get_descendants()
+        else:
+            context[self.context_var] = node.get_descendants(
+                max_depth=self.max_depth)
+        return ''
+
+class AddTreePathsNode(template.Node):
+    def __init__(self, nodes, path_attr, separator=u' :: ',
+                 include_self=False):
+        self.nodes = template.Variable(nodes)
+        self.path_attr = path_attr
+        self.separator = separator
+        self.include_self = include_self
+
+    def render(self, context):
+        # Let any VariableDoesNotExist raised bubble up
+        add_tree_paths(self.nodes.resolve(context), self.path_attr,
+                       self.separator, self.include_self)
+        return ''
+
+class RecurseTreeNode(template.Node):
+    def __init__(self, template_nodes, queryset_var):
+        self.template_nodes = template_nodes
+        self.queryset_var = template.Variable(queryset_var)
+
+    def render(self, context):
+        # Let any VariableDoesNotExist raised bubble up
+        nodes = list(self.queryset_var.resolve(context))
+        pks = set([node.pk for node in nodes])
+        # Rendered children of each node, in reverse order
+        rendered_children = {}
+        roots = []
+        # Every node follows its parent in tree order, so rendering the
+        # nodes in reverse means their children are always rendered
+        # first, without any recursion.
+        for node in reversed(nodes):
+            children = rendered_children.pop(node.pk, [])
+            children.reverse()
+            context.push()
+            context['node'] = node
+            context['children'] = mark_safe(u''.join(children))
+            rendered = self.template_nodes.render(context)
+            context.pop()
+            parent_id = getattr(node, '%s_id' % node._meta.parent_attr)
+            if parent_id in pks:
+                rendered_children.setdefault(parent_id, []).append(rendered)
+            else:
+                roots.append(rendered)
+        roots.reverse()
+        return u''.join(roots)
+
 def do_full_tree_for_model(parser, token):
     """
     Populates a template variable with a ``QuerySet`` containing the
@@ -59,19 +137,37 @@ def do_full_tree_for_model(parser, token):
     Usage::
 
        {% full_tree_for_model [model] as [varname] %}
+       {% full_tree_for_model [model] as [varname] cached %}
+       {% full_tree_for_model [model] as [varname] cached [timeout] %}
 
     The model is specified in ``[appname].[modelname]`` format.
 
-    Example::
+    If ``cached`` is specified, a list of the nodes in the tree will be
+    kept in the cache, optionally for the given number of seconds, until
+    the tree is next written to.
+
+    Examples::
 
        {% full_tree_for_model tests.Genre as genres %}
+       {% full_tree_for_model tests.Genre as genres cached 3600 %}
 
     """
     bits = token.contents.split()
-    if len(bits) != 4:
-        raise template.TemplateSyntaxError(_('%s tag requires three arguments') % bits[0])
+    len_bits = len(bits)
+    if len_bits not in (4, 5, 6):
+        raise template.TemplateSyntaxError(_('%s tag requires either three, four or five arguments') % bits[0])
     if bits[2] != 'as':
         raise template.TemplateSyntaxError(_("second argument to %s tag must be 'as'") % bits[0])
+    if len_bits > 4:
+        if bits[4] != 'cached':
+            raise template.TemplateSyntaxError(_("fourth argument to %s tag must be 'cached'") % bits[0])
+        cache_timeout = None
+        if len_bits == 6:
+            try:
+                cache_timeout = int(bits[5])
+            except ValueError:
+                raise template.TemplateSyntaxError(_('%s tag was given an invalid cache timeout: %s') % (bits[0], bits[5]))
+        return FullTreeForModelNode(bits[1], bits[3], True, cache_timeout)
     return FullTreeForModelNode(bits[1], bits[3])
 
 def do_drilldown_tree_for_node(parser, token):
@@ -140,6 +236,122 @@ def do_drilldown_tree_for_node(parser, token):
     else:
         return DrilldownTreeForNodeNode(bits[1], bits[3])
 
+def do_descendants_for_node(parser, token):
+    """
+    Populates a template variable with a ``QuerySet`` containing the
+    descendants of a given node, optionally limited to those which are
+    at most a given number of levels below it.
+
+    Usage::
+
+       {% descendants_for_node [node] as [varname] %}
+       {% descendants_for_node [node] as [varname] max_depth [depth] %}
+
+    Examples::
+
+       {% descendants_for_node genre as descendants %}
+       {% descendants_for_node genre as descendants max_depth 2 %}
+
+    """
+    bits = token.contents.split()
+    len_bits = len(bits)
+    if len_bits not in (4, 6):
+        raise template.TemplateSyntaxError(_('%s tag requires either three or five arguments') % bits[0])
+    if bits[2] != 'as':
+        raise template.TemplateSyntaxError(_("second argument to %s tag must be 'as'") % bits[0])
+    if len_bits == 6:
+        if bits[4] != 'max_depth':
+            raise template.TemplateSyntaxError(_("if five arguments are given, fourth argument to %s tag must be 'max_depth'") % bits[0])
+        try:
+            max_depth = int(bits[5])
+        except ValueError:
+            raise template.TemplateSyntaxError(_('%s tag was given an invalid max_depth: %s') % (bits[0], bits[5]))
+        return DescendantsForNodeNode(bits[1], bits[3], max_depth)
+    return DescendantsForNodeNode(bits[1], bits[3])
+
+def do_add_tree_paths(parser, token):
+    """
+    Adds an attribute containing the tree path of each node in a list
+    of nodes - the unicode representations of its ancestors joined with
+    a separator, as if using the ``tree_path`` filter on each node's
+    ancestors - retrieving the ancestors of all the nodes at once.
+
+    Usage::
+
+       {% add_tree_paths [nodes] in [path_attr] %}
+
+    Extended usage::
+
+       {% add_tree_paths [nodes] in [path_attr] separator [separator] %}
+       {% add_tree_paths [nodes] in [path_attr] include_self %}
+       {% add_tree_paths [nodes] in [path_attr] separator [separator] include_self %}
+
+    If ``include_self`` is specified, each node itself will also be
+    included at the end of its path.
+
+    Examples::
+
+       {% add_tree_paths genres in path %}
+       {% add_tree_paths genres in breadcrumbs separator " > " include_self %}
+
+    """
+    bits = token.split_contents()
+    len_bits = len(bits)
+    if len_bits < 4:
+        raise template.TemplateSyntaxError(_('%s tag requires at least three arguments') % bits[0])
+    if bits[2] != 'in':
+        raise template.TemplateSyntaxError(_("second argument to %s tag must be 'in'") % bits[0])
+    kwargs = {}
+    options = bits[4:]
+    if options and options[-1] == 'include_self':
+        kwargs['include_self'] = True
+        options = options[:-1]
+    if options:
+        if len(options) != 2 or options[0] != 'separator':
+            raise template.TemplateSyntaxError(_("fourth argument to %s tag must be 'separator' or 'include_self'") % bits[0])
+        separator = options[1]
+        if not (separator[0] == separator[-1] and separator[0] in ('"', "'")):
+            raise template.TemplateSyntaxError(_('%s tag separator must be quoted') % bits[0])
+        kwargs['separator'] = separator[1:-1]
+    return AddTreePathsNode(bits[1], bits[3], **kwargs)
+
+def do_recursetree(parser, token):
+    """
+    Iterates over the nodes in a list of tree items, which must be in
+    tree order, rendering the contents of the block for each one with
+    the node available as ``node`` and its already rendered children
+    available as ``children``.
+
+    The whole list is rendered in a single pass without any further
+    database queries, as the children of each node are found within the
+    list itself. Nodes whose parents aren't in the list are rendered at
+    the top level.
+
+    Usage::
+
+       {% recursetree [nodes] %}
+       ...
+       {% endrecursetree %}
+
+    Example::
+
+       <ul>
+       {% recursetree genres %}
+          <li>
+             {{ node.name }}
+             {% if children %}<ul>{{ children }}</ul>{% endif %}
+          </li>
+       {% endrecursetree %}
+       </ul>
+
+    """
+    bits = token.contents.split()
+    if len(bits) != 2:
+        raise template.TemplateSyntaxError(_('%s tag requires a list of nodes') % bits[0])
+    template_nodes = parser.parse(('endrecursetree',))
+    parser.delete_first_token()
+    return RecurseTreeNode(template_nodes, bits[1])
+
 def tree_info(items, features=None):
     """
     Given a list of tree items, produces doubles of a tree item and a
@@ -191,7 +403,27 @@ def tree_path(items, separator=' :: '):
     """
     return separator.join([force_unicode(i) for i in items])
 
+def stored_path(node, separator=' :: '):
+    """
+    Joins the parts of the path stored for a ``node`` whose model has
+    the ``path_field`` tree option set with a ``separator``, so no
+    queries are required. The node itself is included at the end of
+    the path.
+
+    Example::
+
+       {{ some_node|stored_path:" > " }}
+
+    """
+    opts = node._meta
+    return separator.join(getattr(node, opts.path_field).split(
+        opts.path_separator))
+
 register.tag('full_tree_for_model', do_full_tree_for_model)
 register.tag('drilldown_tree_for_node', do_drilldown_tree_for_node)
+register.tag('descendants_for_node', do_descendants_for_node)
+register.tag('add_tree_paths', do_add_tree_paths)
+register.tag('recursetree', do_recursetree)
 register.filter('tree_info', tree_info)
 register.filter('tree_path', tree_path)
+register.filter('stored_path', stored_path)
@@ -47,6 +47,11 @@ r"""
 (<Genre: Role-playing Game>, <Genre: Action RPG>, <Genre: Tactical RPG>)
 (<Genre: Action RPG>, <Genre: Tactical RPG>, None)
 
+>>> list(previous_current_next(Genre.tree.filter(pk=action.pk).iterator()))
+[(None, <Genre: Action>, None)]
+>>> list(previous_current_next([]))
+[]
+
 >>> for i,s in tree_item_iterator(Genre.tree.all()):
 ...     print (i, s['new_level'], s['closed_levels'])
 (<Genre: Action>, True, [])
@@ -152,6 +157,23 @@ r"""
 <option value="8">+-- Tactical RPG</option>
 </select>
 
+>>> f = TreeNodeChoiceField(queryset=Genre.tree.filter(tree_id=2), label_field='name', level_indicator=u'+--')
+>>> print(f.widget.render("test", None))
+<select name="test">
+<option value="6"> Role-playing Game</option>
+<option value="7">+-- Action RPG</option>
+<option value="8">+-- Tactical RPG</option>
+</select>
+
+>>> f = TreeNodeChoiceField(queryset=Genre.tree.all(), max_level=0, children_url='/genres/')
+>>> print(f.widget.render("test", None))
+<select data-children-url="/genres/" name="test">
+<option value="1"> Action</option>
+<option value="6"> Role-playing Game</option>
+</select>
+>>> f.clean('4')
+<Genre: 3D Platformer>
+
 >>> form = MoveNodeForm(Genre.objects.get(pk=7))
 >>> print(form)
 <tr><th><label for="id_target">Target:</label></th><td><select id="id_target" name="target" size="10">
@@ -170,6 +192,15 @@ r"""
 <option value="right">Right sibling</option>
 </select></td></tr>
 
+>>> form = MoveNodeForm(Genre.objects.get(pk=2), {'target': '4', 'position': 'left'})
+>>> form.is_valid()
+False
+>>> form.errors['target']
+[u'A node may not be moved relative to itself or any of its descendants.']
+>>> form = MoveNodeForm(Genre.objects.get(pk=2), {'target': '8', 'position': 'left'})
+>>> form.is_valid()
+True
+
 >>> form = MoveNodeForm(Genre.objects.get(pk=7), level_indicator=u'+--', target_select_size=5)
 >>> print(form)
 <tr><th><label for="id_target">Target:</label></th><td><select id="id_target" name="target" size="5">
@@ -202,6 +233,11 @@ DoesNotExist: Genre matching query does not exist.
 >>> [g.name for g in Genre.tree.root_nodes()]
 [u'Action', u'Role-playing Game']
 
+>>> [g.name for g in Genre.tree.leaf_nodes()]
+[u'2D Platformer', u'3D Platformer', u'4D Platformer', u'Action RPG', u'Tactical RPG']
+>>> [g.name for g in Genre.tree.leaf_nodes(rpg.tree_id)]
+[u'Action RPG', u'Tactical RPG']
+
 # Model Instance Methods ######################################################
 >>> action = Genre.objects.get(pk=action.pk)
 >>> [g.name for g in action.get_ancestors()]
@@ -216,6 +252,8 @@ DoesNotExist: Genre matching query does not exist.
 [u'Action', u'Platformer', u'2D Platformer', u'3D Platformer', u'4D Platformer']
 >>> action.get_descendant_count()
 4
+>>> [g.name for g in action.get_leafnodes()]
+[u'2D Platformer', u'3D Platformer', u'4D Platformer']
 >>> action.get_previous_sibling()
 >>> action.get_next_sibling()
 <Genre: Role-playing Game>
@@ -273,6 +311,10 @@ False
 [u'3D Platformer']
 >>> platformer_3d.get_descendant_count()
 0
+>>> [g.name for g in platformer_3d.get_leafnodes()]
+[]
+>>> [g.name for g in platformer_3d.get_leafnodes(include_self=True)]
+[u'3D Platformer']
 >>> platformer_3d.get_previous_sibling()
 <Genre: 2D Platformer>
 >>> platformer_3d.get_next_sibling()
@@ -289,6 +331,14 @@ False
 True
 >>> platformer_3d.is_leaf_node()
 True
+>>> platformer_3d.is_descendant_of(action), platformer_3d.is_descendant_of(platformer_3d)
+(True, False)
+>>> platformer_3d.is_descendant_of(platformer_3d, include_self=True)
+True
+>>> action.is_ancestor_of(platformer_3d), platformer_3d.is_ancestor_of(action)
+(True, False)
+>>> platformer_3d.is_descendant_of(rpg)
+False
 
 # The move_to method will be used in other tests to verify that it calls the
 # TreeManager correctly.
@@ -59,9 +59,58 @@ class OrderedInsertion(mptt.Model):
         return self.name
 
 
+class PathNode(mptt.Model):
+    slug = models.SlugField()
+    parent = models.ForeignKey('self', null=True, blank=True, related_name='children')
+    path = models.CharField(max_length=255, db_index=True, editable=False)
+
+    class MpttMeta:
+        path_field = 'path'
+
+    def __unicode__(self):
+        return self.slug
+
+
+class RecursiveNode(mptt.Model):
+    name = models.CharField(max_length=50)
+    parent = models.ForeignKey('self', null=True, blank=True, related_name='children')
+
+    class MpttMeta:
+        query_strategy = 'recursive'
+
+    def __unicode__(self):
+        return self.name
+
+
+class RecursiveItem(models.Model):
+    node = models.ForeignKey(RecursiveNode, related_name='items')
+
+
+class VisibleManager(models.Manager):
+    def get_query_set(self):
+        return super(VisibleManager, self).get_query_set().filter(hidden=False)
+
+class HiddenNode(mptt.Model):
+    name = models.CharField(max_length=50)
+    parent = models.ForeignKey('self', null=True, blank=True, related_name='children')
+    hidden = models.BooleanField(default=False)
+
+    objects = VisibleManager()
+
+    def __unicode__(self):
+        return self.name
+
+
 class Tree(mptt.Model):
     parent = models.ForeignKey('self', null=True, blank=True, related_name='children')
 
+    class MpttMeta:
+        composite_indexes = True
+
+
+class SubTree(Tree):
+    name = models.CharField(max_length=50)
+
 
 class AbstractModel(mptt.Model):
     name = models.CharField(max_length=50)
@@ -143,4 +192,15 @@ class LoadTreeNode(mptt.LoadTreeModel):
     
     def __unicode__(self):
         return self.name
+
+class PartialLoadTreeNode(mptt.LoadTreeModel):
+    name = models.CharField(max_length=50)
+    parent = models.ForeignKey('self', null=True, blank=True, related_name='children')
+
+    class MpttMeta:
+        partial_tree_loading = True
+        partial_tree_depth = 1
+
+    def __unicode__(self):
+        return self.name
     
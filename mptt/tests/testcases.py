@@ -1,10 +1,24 @@
 import re
+import sys
+import threading
 
 from django.conf import settings
-from django.db import connection
-from django.test import TestCase
+from django.core.management.sql import emit_post_sync_signal
+from django.core.signals import request_finished
+from django.db import connection, transaction
+from django.http import Http404, HttpRequest
+from django.template import Context, Template, TemplateSyntaxError
+from django.test import TestCase, TransactionTestCase
+from django.utils import simplejson
 
 from mptt.exceptions import InvalidMove
+from mptt.forms import MAX_CACHED_TREE_CHOICES, TreeNodeChoiceField
+from mptt.managers import reset_pending_tree_versions
+from mptt.models import _get_composite_indexes
+from mptt.resolve import PathResolver, _estimate_size
+from mptt.utils import add_tree_paths, drilldown_tree_for_node, \
+    prefetch_tree_relations
+from mptt.views import node_children
 from mptt.tests import doctests
 from mptt.tests import models
 
@@ -28,6 +42,18 @@ def tree_details(text):
     """
     return leading_whitespace_re.sub('', text)
 
+class QueryCountTestCase(TestCase):
+    """
+    A ``TestCase`` which switches ``DEBUG`` on while each test runs, so
+    the queries it makes are logged and can be counted.
+    """
+    def setUp(self):
+        self.original_debug = settings.DEBUG
+        settings.DEBUG = True
+
+    def tearDown(self):
+        settings.DEBUG = self.original_debug
+
 # models.Genres.json defines the following tree structure
 #
 # 1 - 1 0 1 16   action
@@ -302,6 +328,809 @@ class DeletionTestCase(TestCase):
                                          9 8 1 2 9 10
                                          10 8 1 2 11 12"""))
 
+class CompositeIndexTestCase(TestCase):
+    """
+    Tests that composite indexes are created for models which ask for
+    them with the ``composite_indexes`` tree option.
+    """
+    def get_index_columns(self, model):
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s",
+                       [model._meta.db_table])
+        columns = []
+        for (name,) in cursor.fetchall():
+            cursor.execute('PRAGMA index_info(%s)' % connection.ops.quote_name(name))
+            columns.append(tuple([row[2] for row in cursor.fetchall()]))
+        return columns
+
+    def test_composite_indexes(self):
+        if settings.DATABASE_ENGINE != 'sqlite3':
+            return
+        columns = self.get_index_columns(models.Tree)
+        self.assertTrue(('tree_id', 'lft') in columns)
+        self.assertTrue(('tree_id', 'rght') in columns)
+        self.assertFalse(('tree_id', 'lft') in self.get_index_columns(models.Genre))
+
+    def test_concrete_subclass(self):
+        self.assertEqual(_get_composite_indexes(models.Tree),
+                         [['tree_id', 'lft'], ['tree_id', 'rght']])
+        self.assertEqual(_get_composite_indexes(models.SubTree), [])
+        if settings.DATABASE_ENGINE == 'sqlite3':
+            self.assertEqual(self.get_index_columns(models.SubTree),
+                             [])
+
+    def test_existing_indexes(self):
+        # flush sends post_syncdb with every model
+        emit_post_sync_signal([models.Tree], 0, False)
+        if settings.DATABASE_ENGINE == 'sqlite3':
+            columns = self.get_index_columns(models.Tree)
+            self.assertEqual(columns.count(('tree_id', 'lft')), 1)
+
+class TraversalCacheTestCase(QueryCountTestCase):
+    """
+    Tests that traversal methods cache their results on model instances
+    until the tree changes.
+    """
+    fixtures = ['genres.json']
+
+    def test_repeated_calls(self):
+        node = models.Genre.objects.get(pk=4)
+        query_count = len(connection.queries)
+        for i in range(3):
+            self.assertEqual([g.pk for g in node.get_ancestors()], [1, 2])
+            self.assertEqual(node.get_root().pk, 1)
+        self.assertEqual(len(connection.queries), query_count + 2)
+        parent = models.Genre.objects.get(pk=2)
+        query_count = len(connection.queries)
+        for i in range(3):
+            self.assertEqual([g.pk for g in parent.get_children()], [3, 4, 5])
+        self.assertEqual(len(connection.queries), query_count + 1)
+
+    def test_select_related_parents(self):
+        node = models.Genre.objects.select_related('parent__parent').get(pk=4)
+        query_count = len(connection.queries)
+        self.assertEqual([g.pk for g in node.get_ancestors()], [1, 2])
+        self.assertEqual([g.pk for g in node.get_ancestors(ascending=True)], [2, 1])
+        self.assertEqual(node.get_root().pk, 1)
+        self.assertEqual(len(connection.queries), query_count)
+
+    def test_invalidation(self):
+        action = models.Genre.objects.get(pk=1)
+        self.assertEqual([g.pk for g in action.get_children()], [2, 6])
+        models.Genre.objects.get(pk=8).move_to(action)
+        self.assertEqual([g.pk for g in action.get_children()], [8, 2, 6])
+        shmup = models.Genre.objects.get(pk=6)
+        shmup.name = 'Shoot em up'
+        shmup.save()
+        self.assertEqual(action.get_children()[2].name, 'Shoot em up')
+
+class PrefetchTreeRelationsTestCase(QueryCountTestCase):
+    """
+    Tests that relations loaded by ``prefetch_tree_relations`` are used
+    by traversal methods.
+    """
+    fixtures = ['genres.json']
+
+    def test_children(self):
+        query_count = len(connection.queries)
+        nodes = list(models.Genre.tree.all().prefetch_tree_relations())
+        self.assertEqual(len(connection.queries), query_count + 2)
+        self.assertEqual([[c.pk for c in n.get_children()] for n in nodes],
+                         [[2, 6], [3, 4, 5], [], [], [], [7, 8], [], [],
+                          [10, 11], [], []])
+        self.assertEqual(len(connection.queries), query_count + 2)
+
+    def test_ancestors_and_descendants(self):
+        nodes = list(models.Genre.objects.filter(pk__in=[2, 4, 7, 9, 11]))
+        query_count = len(connection.queries)
+        prefetch_tree_relations(nodes, children=True, ancestors=True,
+                                descendants=True)
+        self.assertEqual(len(connection.queries), query_count + 2)
+        self.assertEqual(dict([(n.pk, [a.pk for a in n.get_ancestors()]) for n in nodes]),
+                         {2: [1], 4: [1, 2], 7: [1, 6], 9: [], 11: [9]})
+        self.assertEqual([a.pk for a in nodes[1].get_ancestors(ascending=True)],
+                         [2, 1])
+        self.assertEqual(dict([(n.pk, [d.pk for d in n.get_descendants()]) for n in nodes]),
+                         {2: [3, 4, 5], 4: [], 7: [], 9: [10, 11], 11: []})
+        self.assertEqual(dict([(n.pk, [c.pk for c in n.get_children()]) for n in nodes]),
+                         {2: [3, 4, 5], 4: [], 7: [], 9: [10, 11], 11: []})
+        self.assertEqual(len(connection.queries), query_count + 2)
+
+    def test_depth_limited_descendants(self):
+        nodes = list(models.Genre.objects.filter(pk__in=[1, 9]))
+        query_count = len(connection.queries)
+        prefetch_tree_relations(nodes, children=False, descendants=1)
+        self.assertEqual(len(connection.queries), query_count + 1)
+        self.assertEqual([[d.pk for d in n.get_descendants(max_depth=1)] for n in nodes],
+                         [[2, 6], [10, 11]])
+        self.assertEqual(len(connection.queries), query_count + 1)
+
+    def test_nested_depth_limited_descendants(self):
+        nodes = list(models.Genre.objects.filter(pk__in=[1, 2]))
+        query_count = len(connection.queries)
+        prefetch_tree_relations(nodes, children=True, descendants=1)
+        self.assertEqual(len(connection.queries), query_count + 1)
+        self.assertEqual([[d.pk for d in n.get_descendants(max_depth=1)] for n in nodes],
+                         [[2, 6], [3, 4, 5]])
+        self.assertEqual([[c.pk for c in n.get_children()] for n in nodes],
+                         [[2, 6], [3, 4, 5]])
+        self.assertEqual(len(connection.queries), query_count + 1)
+
+class CachedTreesTestCase(QueryCountTestCase):
+    """
+    Tests that ``get_cached_trees`` loads whole trees with one query.
+    """
+    fixtures = ['genres.json']
+
+    def test_whole_trees(self):
+        query_count = len(connection.queries)
+        roots = models.Genre.tree.get_cached_trees()
+        self.assertEqual(len(connection.queries), query_count + 1)
+        self.assertEqual([r.pk for r in roots], [1, 9])
+        self.assertEqual([[g.pk for g in c.get_children()]
+                          for c in roots[0].get_children()],
+                         [[3, 4, 5], [7, 8]])
+        self.assertEqual(roots[1].get_children()[1].parent.pk, 9)
+        self.assertEqual(len(connection.queries), query_count + 1)
+
+    def test_partial_queryset(self):
+        query_count = len(connection.queries)
+        top_nodes = models.Genre.tree.get_cached_trees(
+            models.Genre.tree.filter(pk__in=[2, 3, 4, 6, 10]))
+        self.assertEqual(len(connection.queries), query_count + 1)
+        self.assertEqual([n.pk for n in top_nodes], [2, 6, 10])
+        self.assertEqual([c.pk for c in top_nodes[0].get_children()], [3, 4])
+        self.assertEqual(list(top_nodes[1].get_children()), [])
+        self.assertEqual(len(connection.queries), query_count + 1)
+
+class OperationRoundTripsTestCase(TestCase):
+    """
+    Tests that the raw statements executed by tree operations share a
+    cursor and are counted.
+    """
+    fixtures = ['genres.json']
+
+    def test_round_trips(self):
+        manager = models.Genre.tree
+        manager.move_node(models.Genre.objects.get(pk=6), None)
+        self.assertEqual(manager.get_operation_round_trips(), 2)
+        manager.move_node(models.Genre.objects.get(pk=4),
+                          models.Genre.objects.get(pk=2), 'first-child')
+        self.assertEqual(manager.get_operation_round_trips(), 1)
+        models.Genre.objects.get(pk=11).delete()
+        self.assertEqual(manager.get_operation_round_trips(), 1)
+        models.Genre.objects.create(name='Puzzle', parent=None)
+        self.assertEqual(manager.get_operation_round_trips(), 1)
+
+    def test_shared_cursor(self):
+        manager = models.Genre.tree
+        cursors = []
+        original_get_cursor = manager._get_cursor
+        def get_cursor():
+            cursor = original_get_cursor()
+            cursors.append(cursor)
+            return cursor
+        manager._get_cursor = get_cursor
+        try:
+            manager.move_node(models.Genre.objects.get(pk=2),
+                              models.Genre.objects.get(pk=9))
+        finally:
+            del manager._get_cursor
+        self.assertEqual(len(cursors), 2)
+        self.assertEqual(len(set([id(c) for c in cursors])), 1)
+        self.assertEqual(manager.get_operation_round_trips(), 2)
+
+def move_node_counting_updates(node, target, position):
+    """
+    Moves ``node`` using its tree manager, returning the number of rows
+    each of the move's ``UPDATE`` statements changed.
+    """
+    manager = node._tree_manager
+    cursors = []
+    row_counts = []
+    original_get_cursor = manager._get_cursor
+    def get_cursor():
+        cursor = original_get_cursor()
+        if cursor in cursors:
+            return cursor
+        cursors.append(cursor)
+        original_execute = cursor.execute
+        def execute(sql, params=()):
+            result = original_execute(sql, params)
+            if sql.strip().startswith('UPDATE'):
+                row_counts.append(cursor.rowcount)
+            return result
+        cursor.execute = execute
+        return cursor
+    manager._get_cursor = get_cursor
+    try:
+        manager.move_node(node, target, position)
+    finally:
+        del manager._get_cursor
+    return row_counts
+
+class InterTreeMoveWindowTestCase(TestCase):
+    """
+    Tests that moving a node out of its tree only updates rows which end
+    after it starts.
+    """
+    fixtures = ['genres.json']
+
+    def test_move_to_new_tree(self):
+        self.assertEqual(move_node_counting_updates(
+            models.Genre.objects.get(pk=7), None, 'last-child'), [4])
+        self.assertEqual(get_tree_details(models.Genre.tree.filter(tree_id=1)),
+                         tree_details("""1 - 1 0 1 14
+                                         2 1 1 1 2 9
+                                         3 2 1 2 3 4
+                                         4 2 1 2 5 6
+                                         5 2 1 2 7 8
+                                         6 1 1 1 10 13
+                                         8 6 1 2 11 12"""))
+
+class MoveWindowTestCase(TestCase):
+    """
+    Tests that moves within a tree only update rows within the affected
+    part of the tree.
+    """
+    fixtures = ['genres.json']
+
+    def test_move_within_tree(self):
+        self.assertEqual(move_node_counting_updates(
+            models.Genre.objects.get(pk=5), models.Genre.objects.get(pk=4),
+            'left'), [2])
+        self.assertEqual(get_tree_details(models.Genre.tree.all()),
+                         tree_details("""1 - 1 0 1 16
+                                         2 1 1 1 2 9
+                                         3 2 1 2 3 4
+                                         5 2 1 2 5 6
+                                         4 2 1 2 7 8
+                                         6 1 1 1 10 15
+                                         7 6 1 2 11 12
+                                         8 6 1 2 13 14
+                                         9 - 2 0 1 6
+                                         10 9 2 1 2 3
+                                         11 9 2 1 4 5"""))
+
+class DescendantDepthTestCase(TestCase):
+    """
+    Tests that descendants can be limited to those within a range of
+    levels below a node.
+    """
+    fixtures = ['genres.json']
+
+    def test_get_descendants(self):
+        node = models.Genre.objects.get(pk=1)
+        self.assertEqual([g.pk for g in node.get_descendants(max_depth=1)],
+                         [2, 6])
+        self.assertEqual([g.pk for g in node.get_descendants(include_self=True, max_depth=1)],
+                         [1, 2, 6])
+        self.assertEqual([g.pk for g in node.get_descendants(min_depth=2)],
+                         [3, 4, 5, 7, 8])
+        self.assertEqual([g.pk for g in node.get_descendants(include_self=True, min_depth=1, max_depth=1)],
+                         [2, 6])
+        self.assertEqual([g.pk for g in node.get_descendants(max_depth=0)], [])
+
+    def test_template_tag(self):
+        t = Template('{% load mptt_tags %}'
+                     '{% descendants_for_node genre as descendants max_depth 1 %}'
+                     '{% for g in descendants %}{{ g.pk }} {% endfor %}')
+        self.assertEqual(t.render(Context({'genre': models.Genre.objects.get(pk=1)})),
+                         u'2 6 ')
+        self.assertRaises(TemplateSyntaxError, Template,
+                          '{% load mptt_tags %}'
+                          '{% descendants_for_node genre as descendants max_depth x %}')
+
+class CachedFullTreeTestCase(QueryCountTestCase):
+    """
+    Tests that the ``full_tree_for_model`` tag's cached lists of nodes
+    are used until the tree changes.
+    """
+    fixtures = ['genres.json']
+
+    def setUp(self):
+        super(CachedFullTreeTestCase, self).setUp()
+        # Loading fixtures doesn't change the tree version
+        models.Genre.tree._bump_tree_version()
+
+    def render(self):
+        t = Template('{% load mptt_tags %}'
+                     '{% full_tree_for_model tests.Genre as genres cached %}'
+                     '{% for g in genres %}{{ g.name }},{% endfor %}')
+        return t.render(Context())
+
+    def test_cached(self):
+        query_count = len(connection.queries)
+        output = self.render()
+        self.assert_(output.startswith(u'Action,Platformer,'))
+        self.assertEqual(self.render(), output)
+        self.assertEqual(len(connection.queries), query_count + 1)
+        node = models.Genre.objects.get(pk=1)
+        node.name = 'Arcade'
+        node.save()
+        query_count = len(connection.queries)
+        self.assert_(self.render().startswith(u'Arcade,Platformer,'))
+        self.assertEqual(len(connection.queries), query_count + 1)
+
+    def test_reset_after_commit(self):
+        version = models.Genre.tree.get_shared_tree_version()
+        self.assertEqual(models.Genre.tree.get_shared_tree_version(), version)
+        models.Genre.objects.get(pk=4).move_to(models.Genre.objects.get(pk=9))
+        moved_version = models.Genre.tree.get_shared_tree_version()
+        self.assertNotEqual(moved_version, version)
+        # Tests run within a managed transaction, so the version is
+        # changed again once it's taken to have been committed
+        reset_pending_tree_versions()
+        committed_version = models.Genre.tree.get_shared_tree_version()
+        self.assertNotEqual(committed_version, moved_version)
+        reset_pending_tree_versions()
+        self.assertEqual(models.Genre.tree.get_shared_tree_version(),
+                         committed_version)
+
+class SharedTreeVersionThreadTestCase(TransactionTestCase):
+    """
+    Tests that shared tree versions are changed again after managed
+    transactions in any thread are committed.
+    """
+    def test_commit_in_thread(self):
+        versions = []
+        written = threading.Event()
+        committed = threading.Event()
+        def write():
+            transaction.enter_transaction_management()
+            transaction.managed(True)
+            try:
+                models.Genre.tree._bump_tree_version()
+                versions.append(models.Genre.tree.get_shared_tree_version())
+                written.set()
+                committed.wait()
+                transaction.commit()
+            finally:
+                transaction.leave_transaction_management()
+            request_finished.send(sender=self.__class__)
+            versions.append(models.Genre.tree.get_shared_tree_version())
+        thread = threading.Thread(target=write)
+        thread.start()
+        written.wait()
+        # Another thread's request finishing mustn't count as the commit
+        request_finished.send(sender=self.__class__)
+        self.assertEqual(models.Genre.tree.get_shared_tree_version(),
+                         versions[0])
+        committed.set()
+        thread.join()
+        self.assertNotEqual(versions[1], versions[0])
+        self.assertEqual(models.Genre.tree.get_shared_tree_version(),
+                         versions[1])
+
+class AddTreePathsTestCase(QueryCountTestCase):
+    """
+    Tests that the tree paths of many nodes are added using a single
+    query for their ancestors.
+    """
+    fixtures = ['genres.json']
+
+    def setUp(self):
+        super(AddTreePathsTestCase, self).setUp()
+        request_finished.send(sender=self.__class__)
+
+    def test_add_tree_paths(self):
+        nodes = list(models.Genre.objects.filter(pk__in=[3, 4, 7, 9, 11]))
+        query_count = len(connection.queries)
+        add_tree_paths(nodes, 'path')
+        self.assertEqual([n.path for n in nodes],
+                         [u'Action :: Platformer', u'Action :: Platformer',
+                          u'Action :: Shootemup', u'', u'Role-playing Game'])
+        self.assertEqual(len(connection.queries), query_count + 1)
+        # Ancestors are kept for the rest of the request
+        nodes = list(models.Genre.objects.filter(pk__in=[2, 5]))
+        query_count = len(connection.queries)
+        add_tree_paths(nodes, 'path', u' > ', include_self=True)
+        self.assertEqual([n.path for n in nodes],
+                         [u'Action > Platformer',
+                          u'Action > Platformer > 4D Platformer'])
+        self.assertEqual(len(connection.queries), query_count)
+
+    def test_template_tag(self):
+        t = Template('{% load mptt_tags %}'
+                     '{% add_tree_paths genres in path separator " > " include_self %}'
+                     '{% for g in genres %}{{ g.path }}|{% endfor %}')
+        genres = models.Genre.objects.filter(pk__in=[4, 10])
+        self.assertEqual(t.render(Context({'genres': genres})),
+                         u'Action &gt; Platformer &gt; 3D Platformer|'
+                         u'Role-playing Game &gt; Action RPG|')
+
+class RecurseTreeTestCase(TestCase):
+    """
+    Tests that the ``recursetree`` tag renders nested trees.
+    """
+    fixtures = ['genres.json']
+
+    def render(self, nodes):
+        t = Template('{% load mptt_tags %}'
+                     '{% recursetree nodes %}'
+                     '[{{ node.pk }}{% if children %}: {{ children }}{% endif %}]'
+                     '{% endrecursetree %}')
+        return t.render(Context({'nodes': nodes}))
+
+    def test_recursetree(self):
+        self.assertEqual(self.render(models.Genre.tree.all()),
+                         u'[1: [2: [3][4][5]][6: [7][8]]][9: [10][11]]')
+        self.assertEqual(self.render(models.Genre.tree.filter(pk__in=[2, 4, 5, 6, 10])),
+                         u'[2: [4][5]][6][10]')
+
+    def test_deep_tree(self):
+        parent = None
+        for i in range(sys.getrecursionlimit() + 10):
+            parent = models.Genre.objects.create(name=str(i), parent=parent)
+        output = self.render(models.Genre.tree.filter(tree_id=parent.tree_id))
+        self.assertEqual(output.count('['), i + 1)
+
+class SiblingNavigationTestCase(TestCase):
+    """
+    Tests that siblings are looked up using the tree fields.
+    """
+    fixtures = ['genres.json']
+
+    def test_next_and_previous_siblings(self):
+        m = models.Genre.objects
+        self.assertEqual(m.get(pk=4).get_next_sibling().pk, 5)
+        self.assertEqual(m.get(pk=4).get_previous_sibling().pk, 3)
+        self.assertEqual(m.get(pk=5).get_next_sibling(), None)
+        self.assertEqual(m.get(pk=3).get_previous_sibling(), None)
+        self.assertEqual(m.get(pk=1).get_next_sibling().pk, 9)
+        self.assertEqual(m.get(pk=1).get_previous_sibling(), None)
+        self.assertEqual(m.get(pk=9).get_previous_sibling().pk, 1)
+        self.assertEqual(m.get(pk=9).get_next_sibling(), None)
+
+    def test_get_siblings_window(self):
+        m = models.Genre.objects
+        node = m.get(pk=4)
+        self.assertEqual([g.pk for g in node.get_siblings_window(1)], [3, 5])
+        self.assertEqual([g.pk for g in node.get_siblings_window(1, include_self=True)],
+                         [3, 4, 5])
+        node = m.get(pk=3)
+        self.assertEqual([g.pk for g in node.get_siblings_window(1)], [4])
+        self.assertEqual([g.pk for g in node.get_siblings_window(5)], [4, 5])
+        node = m.get(pk=4)
+        self.assertEqual(list(node.get_siblings_window(0)), [])
+        self.assertEqual([g.pk for g in node.get_siblings_window(0, include_self=True)],
+                         [4])
+        self.assertEqual(list(node.get_siblings_window(-1)), [])
+        m.create(name='Sports')
+        m.create(name='Strategy')
+        self.assertEqual([g.name for g in m.get(pk=9).get_siblings_window(1)],
+                         ['Action', 'Sports'])
+
+class TreeNodeChoiceFieldTestCase(QueryCountTestCase):
+    """
+    Tests that choices are shared between fields until the tree changes
+    when ``cache_choices`` is set.
+    """
+    fixtures = ['genres.json']
+
+    def setUp(self):
+        super(TreeNodeChoiceFieldTestCase, self).setUp()
+        request_finished.send(sender=self.__class__)
+
+    def test_cache_choices(self):
+        def render():
+            f = TreeNodeChoiceField(queryset=models.Genre.tree.filter(tree_id=2),
+                                    label_field='name', cache_choices=True)
+            return [label for key, label in f.choices]
+        query_count = len(connection.queries)
+        choices = render()
+        self.assertEqual(choices, [u' Role-playing Game', u'--- Action RPG',
+                                   u'--- Tactical RPG'])
+        self.assertEqual(render(), choices)
+        self.assertEqual(len(connection.queries), query_count + 1)
+        node = models.Genre.objects.get(pk=10)
+        node.name = 'Action-adventure RPG'
+        node.save()
+        query_count = len(connection.queries)
+        self.assertEqual(render()[1], u'--- Action-adventure RPG')
+        self.assertEqual(len(connection.queries), query_count + 1)
+
+    def test_cache_discarded(self):
+        def render(tree_id, cache_choices=True):
+            f = TreeNodeChoiceField(queryset=models.Genre.tree.filter(tree_id=tree_id),
+                                    label_field='name',
+                                    cache_choices=cache_choices)
+            return list(f.choices)
+        render(2)
+        query_count = len(connection.queries)
+        render(2, cache_choices=False)
+        self.assertEqual(len(connection.queries), query_count + 1)
+        request_finished.send(sender=self.__class__)
+        render(2)
+        self.assertEqual(len(connection.queries), query_count + 2)
+        for tree_id in range(MAX_CACHED_TREE_CHOICES):
+            render(tree_id + 3)
+        query_count = len(connection.queries)
+        render(2)
+        self.assertEqual(len(connection.queries), query_count + 1)
+
+class NodeChildrenViewTestCase(TestCase):
+    """
+    Tests that the ``node_children`` view lists the children of a node.
+    """
+    fixtures = ['genres.json']
+
+    def get_children(self, queryset, **kwargs):
+        request = HttpRequest()
+        request.GET.update(kwargs)
+        response = node_children(request, queryset)
+        return simplejson.loads(response.content)
+
+    def test_node_children(self):
+        self.assertEqual(self.get_children(models.Genre.tree.all()), [
+            {'id': 1, 'label': 'Action', 'level': 0, 'is_leaf': False},
+            {'id': 9, 'label': 'Role-playing Game', 'level': 0, 'is_leaf': False},
+        ])
+        self.assertEqual([n['id'] for n in self.get_children(models.Genre.tree.all(), parent='2')],
+                         [3, 4, 5])
+        self.assertRaises(Http404, self.get_children,
+                          models.Genre.tree.exclude(pk=2), parent='2')
+
+class PathFieldTestCase(TestCase):
+    """
+    Tests that paths stored in the ``path_field`` are maintained as
+    nodes are inserted, moved and renamed.
+    """
+    def setUp(self):
+        m = models.PathNode.objects
+        books = m.create(slug='books')
+        scifi = m.create(slug='sci-fi', parent=m.get(pk=books.pk))
+        m.create(slug='dystopian', parent=m.get(pk=scifi.pk))
+        m.create(slug='fantasy', parent=m.get(pk=books.pk))
+
+    def get_paths(self):
+        return [n.path for n in models.PathNode.tree.all()]
+
+    def test_insertion(self):
+        self.assertEqual(self.get_paths(),
+                         [u'books', u'books/sci-fi', u'books/sci-fi/dystopian',
+                          u'books/fantasy'])
+        node = models.PathNode.objects.get(path='books/sci-fi/dystopian')
+        self.assertEqual(node.slug, u'dystopian')
+
+    def test_move(self):
+        m = models.PathNode.objects
+        scifi = m.get(path='books/sci-fi')
+        scifi.move_to(m.get(path='books/fantasy'))
+        self.assertEqual(scifi.path, u'books/fantasy/sci-fi')
+        self.assertEqual(self.get_paths(),
+                         [u'books', u'books/fantasy', u'books/fantasy/sci-fi',
+                          u'books/fantasy/sci-fi/dystopian'])
+        scifi = m.get(pk=scifi.pk)
+        scifi.parent = None
+        scifi.save()
+        self.assertEqual(self.get_paths(),
+                         [u'books', u'books/fantasy', u'sci-fi',
+                          u'sci-fi/dystopian'])
+
+    def test_rename(self):
+        scifi = models.PathNode.objects.get(path='books/sci-fi')
+        scifi.slug = 'science-fiction'
+        scifi.save()
+        self.assertEqual(self.get_paths(),
+                         [u'books', u'books/science-fiction',
+                          u'books/science-fiction/dystopian', u'books/fantasy'])
+
+    def test_stored_path(self):
+        node = models.PathNode.objects.get(path='books/sci-fi/dystopian')
+        t = Template('{% load mptt_tags %}{{ node|stored_path:" > " }}|'
+                     '{{ node.get_ancestors|tree_path:" > " }}')
+        self.assertEqual(t.render(Context({'node': node})),
+                         u'books &gt; sci-fi &gt; dystopian|books &gt; sci-fi')
+
+class PathResolverTestCase(QueryCountTestCase):
+    """
+    Tests that ``PathResolver`` resolves paths without database access
+    and is kept up to date as the tree changes.
+    """
+    def setUp(self):
+        super(PathResolverTestCase, self).setUp()
+        m = models.PathNode.objects
+        self.books = m.create(slug='books')
+        self.scifi = m.create(slug='sci-fi', parent=m.get(pk=self.books.pk))
+        self.dystopian = m.create(slug='dystopian', parent=m.get(pk=self.scifi.pk))
+        self.fantasy = m.create(slug='fantasy', parent=m.get(pk=self.books.pk))
+        self.resolver = PathResolver(models.PathNode)
+
+    def test_resolve(self):
+        query_count = len(connection.queries)
+        self.assertEqual(self.resolver.resolve('/books/sci-fi/dystopian/'),
+                         self.dystopian.pk)
+        self.assertEqual(self.resolver.resolve('books'), self.books.pk)
+        self.assertEqual(self.resolver.resolve('books/dystopian'), None)
+        self.assertEqual(self.resolver.resolve('sci-fi'), None)
+        self.assertEqual(len(connection.queries), query_count)
+
+    def test_memory_usage(self):
+        self.assertTrue(self.resolver.memory_usage() > 0)
+        self.assertTrue(_estimate_size((None, u'books')) > 0)
+        self.assertTrue(_estimate_size(u'books') >
+                        _estimate_size(u''))
+
+    def test_insert(self):
+        m = models.PathNode.objects
+        m.create(slug='cyberpunk', parent=m.get(pk=self.scifi.pk))
+        self.assertEqual(self.resolver.resolve('books/sci-fi/cyberpunk'),
+                         m.get(slug='cyberpunk').pk)
+
+    def test_move(self):
+        m = models.PathNode.objects
+        scifi = m.get(pk=self.scifi.pk)
+        scifi.move_to(m.get(pk=self.fantasy.pk))
+        self.assertEqual(self.resolver.resolve('books/sci-fi'), None)
+        self.assertEqual(self.resolver.resolve('books/fantasy/sci-fi/dystopian'),
+                         self.dystopian.pk)
+
+    def test_rename(self):
+        scifi = models.PathNode.objects.get(pk=self.scifi.pk)
+        scifi.slug = 'science-fiction'
+        scifi.save()
+        self.assertEqual(self.resolver.resolve('books/sci-fi/dystopian'), None)
+        self.assertEqual(self.resolver.resolve('books/science-fiction/dystopian'),
+                         self.dystopian.pk)
+
+    def test_delete(self):
+        models.PathNode.objects.get(pk=self.scifi.pk).delete()
+        self.assertEqual(self.resolver.resolve('books/sci-fi'), None)
+        self.assertEqual(self.resolver.resolve('books/sci-fi/dystopian'), None)
+        self.assertEqual(self.resolver.resolve('books/fantasy'), self.fantasy.pk)
+
+class DefaultManagerAncestorsTestCase(TestCase):
+    """
+    Tests that ancestors are retrieved through the model's default
+    manager.
+    """
+    def test_get_ancestors(self):
+        m = models.HiddenNode.tree
+        root = m.create(name='root', hidden=True)
+        child = m.create(name='child', parent=m.get(pk=root.pk))
+        grandchild = m.create(name='grandchild', parent=m.get(pk=child.pk))
+        grandchild = m.get(pk=grandchild.pk)
+        self.assertEqual([n.name for n in grandchild.get_ancestors()], ['child'])
+        self.assertEqual([n.name for n in m.get_ancestors(grandchild)],
+                         ['root', 'child'])
+        grandchild = m.get(pk=grandchild.pk)
+        prefetch_tree_relations([grandchild], children=False, ancestors=True)
+        self.assertEqual([n.name for n in grandchild.get_ancestors(ascending=True)],
+                         ['child'])
+
+    def test_drilldown(self):
+        m = models.HiddenNode.tree
+        root = m.create(name='root', hidden=True)
+        child = m.create(name='child', parent=m.get(pk=root.pk))
+        m.create(name='grandchild', parent=m.get(pk=child.pk))
+        m.create(name='hidden', parent=m.get(pk=child.pk), hidden=True)
+        child = m.get(pk=child.pk)
+        self.assertEqual([n.name for n in drilldown_tree_for_node(child)],
+                         ['child', 'grandchild'])
+
+    def test_add_tree_paths(self):
+        m = models.HiddenNode.tree
+        root = m.create(name='root')
+        hidden = m.create(name='hidden', parent=m.get(pk=root.pk), hidden=True)
+        child = m.create(name='child', parent=m.get(pk=hidden.pk))
+        m.create(name='grandchild', parent=m.get(pk=child.pk))
+        m.create(name='other', parent=m.get(pk=root.pk))
+        request_finished.send(sender=self.__class__)
+        nodes = add_tree_paths(m.all(), 'path')
+        t = Template('{% load mptt_tags %}{{ node.get_ancestors|tree_path }}')
+        for node in nodes:
+            self.assertEqual(node.path, t.render(Context({'node': node})))
+        self.assertEqual([n.path for n in nodes],
+                         [u'', u'root', u'root', u'root :: child', u'root'])
+
+class RecursiveQueryStrategyTestCase(TestCase):
+    """
+    Tests that the ``'recursive'`` query strategy follows the parent
+    field rather than relying on the left and right edge indicators.
+    """
+    def setUp(self):
+        m = models.RecursiveNode.objects
+        self.root = m.create(name='root')
+        self.child = m.create(name='child', parent=m.get(pk=self.root.pk))
+        self.grandchild = m.create(name='grandchild', parent=m.get(pk=self.child.pk))
+        self.other = m.create(name='other', parent=m.get(pk=self.root.pk))
+        self.root = m.get(pk=self.root.pk)
+        self.child = m.get(pk=self.child.pk)
+        self.grandchild = m.get(pk=self.grandchild.pk)
+
+    def test_get_ancestors(self):
+        self.assertEqual([n.name for n in self.grandchild.get_ancestors()],
+                         ['root', 'child'])
+        self.assertEqual([n.name for n in self.grandchild.get_ancestors(ascending=True)],
+                         ['child', 'root'])
+        self.assertEqual(list(self.root.get_ancestors()), [])
+
+    def test_get_descendants(self):
+        self.assertEqual([n.name for n in self.root.get_descendants()],
+                         ['child', 'grandchild', 'other'])
+        self.assertEqual([n.name for n in self.child.get_descendants(include_self=True)],
+                         ['child', 'grandchild'])
+        self.assertEqual(list(self.grandchild.get_descendants()), [])
+        self.assertEqual([n.name for n in self.root.get_descendants(max_depth=1)],
+                         ['child', 'other'])
+        self.assertEqual([n.name for n in self.root.get_descendants(include_self=True, min_depth=2)],
+                         ['grandchild'])
+
+    def test_zero_max_depth(self):
+        opts = models.RecursiveNode._meta
+        try:
+            for query_strategy in ('recursive', 'nested_set'):
+                opts.query_strategy = query_strategy
+                self.assertEqual(list(self.root.get_descendants(max_depth=0)), [])
+                self.assertEqual([n.name for n in self.root.get_descendants(include_self=True, max_depth=0)],
+                                 ['root'])
+                self.assertEqual(list(self.root.get_descendants(include_self=True, max_depth=-1)), [])
+        finally:
+            opts.query_strategy = 'recursive'
+
+    def test_invalid_query_strategy(self):
+        opts = models.RecursiveNode._meta
+        opts.query_strategy = 'nested'
+        try:
+            self.assertRaises(ValueError, self.root.get_descendants)
+            self.assertRaises(ValueError, self.grandchild.get_ancestors)
+        finally:
+            opts.query_strategy = 'recursive'
+
+    def test_stale_edge_indicators(self):
+        # Corrupt the left and right edge indicators - the results should
+        # still be correct, as only the parent field is used.
+        models.RecursiveNode.objects.update(lft=1, rght=2)
+        self.assertEqual(sorted([n.name for n in self.grandchild.get_ancestors()]),
+                         ['child', 'root'])
+        self.assertEqual(sorted([n.name for n in self.root.get_descendants()]),
+                         ['child', 'grandchild', 'other'])
+
+    def test_cumulative_count(self):
+        for node in (self.root, self.child, self.grandchild, self.grandchild):
+            models.RecursiveItem.objects.create(node=node)
+        nodes = models.RecursiveNode.tree.add_related_count(
+            models.RecursiveNode.tree.all(), models.RecursiveItem, 'node',
+            'item_count', cumulative=True)
+        self.assertEqual([(n.name, n.item_count) for n in nodes],
+                         [('root', 4), ('child', 3), ('grandchild', 2),
+                          ('other', 0)])
+
+class DrilldownTreeTestCase(QueryCountTestCase):
+    """
+    Tests that drilldown trees are retrieved using a single query.
+    """
+    def setUp(self):
+        super(DrilldownTreeTestCase, self).setUp()
+        m = models.RecursiveNode.objects
+        root = m.create(name='root')
+        child = m.create(name='child', parent=m.get(pk=root.pk))
+        grandchild = m.create(name='grandchild', parent=m.get(pk=child.pk))
+        m.create(name='other', parent=m.get(pk=root.pk))
+        for node in (root, child, grandchild, grandchild):
+            models.RecursiveItem.objects.create(node=node)
+
+    def test_drilldown(self):
+        child = models.RecursiveNode.objects.get(name='child')
+        query_count = len(connection.queries)
+        self.assertEqual([n.name for n in drilldown_tree_for_node(child)],
+                         ['root', 'child', 'grandchild'])
+        self.assertEqual(len(connection.queries), query_count + 1)
+
+    def test_related_count(self):
+        root = models.RecursiveNode.objects.get(name='root')
+        query_count = len(connection.queries)
+        nodes = drilldown_tree_for_node(root, models.RecursiveItem, 'node',
+                                        'item_count', cumulative=True)
+        self.assertEqual([(n.name, n.item_count) for n in nodes],
+                         [('root', None), ('child', 3), ('other', 0)])
+        nodes = drilldown_tree_for_node(root, models.RecursiveItem, 'node',
+                                        'item_count')
+        self.assertEqual([(n.name, n.item_count) for n in nodes],
+                         [('root', None), ('child', 1), ('other', 0)])
+        self.assertEqual(len(connection.queries), query_count + 2)
+
 class IntraTreeMovementTestCase(TestCase):
     pass
 
@@ -425,8 +1254,14 @@ class ProxyCustomAnotherNodeTest(CustomAnotherNodeTest):
     model = models.ProxyCustomAnotherNode
     
 
-class LoadTreeNodeTest(TestCase):
+class LoadTreeNodeTest(QueryCountTestCase):
     fixtures = ['loadtreenode.json']
+
+    def setUp(self):
+        super(LoadTreeNodeTest, self).setUp()
+        # Loading fixtures doesn't change the tree version, so discard
+        # any trees loaded by previous tests as a request would
+        request_finished.send(sender=self.__class__)
         
     def test_get_children(self):
         root = models.LoadTreeNode.objects.get(tree_id=1, parent=None)
@@ -455,6 +1290,40 @@ class LoadTreeNodeTest(TestCase):
         self.assertEqual([c.pk for c in node.get_descendants()], [])
         self.assertEqual([c.pk for c in node.get_descendants(include_self=True)], [7])
     
+    def test_get_leafnodes(self):
+        node = models.LoadTreeNode.objects.get(tree_id=1, parent=None)
+        self.assertEqual([c.pk for c in node.get_leafnodes()], [3, 4, 6, 7, 9, 10])
+        node = models.LoadTreeNode.objects.get(pk=7)
+        self.assertEqual(node.get_leafnodes(), [])
+        self.assertEqual([c.pk for c in node.get_leafnodes(include_self=True)], [7])
+
+    def test_get_descendants_by_depth(self):
+        node = models.LoadTreeNode.objects.get(tree_id=1, parent=None)
+        self.assertEqual([c.pk for c in node.get_descendants(max_depth=1)], [2, 5, 8])
+        self.assertEqual([c.pk for c in node.get_descendants(min_depth=2)], [3, 4, 6, 7, 9, 10])
+        self.assertEqual([c.pk for c in node.get_descendants(include_self=True, max_depth=0)], [1])
+        t = Template('{% load mptt_tags %}'
+                     '{% descendants_for_node node as descendants max_depth 1 %}'
+                     '{% for n in descendants %}{{ n.pk }} {% endfor %}')
+        self.assertEqual(t.render(Context({'node': node})), u'2 5 8 ')
+
+    def test_iter_descendants(self):
+        node = models.LoadTreeNode.objects.get(pk=5)
+        descendants = node.iter_descendants(include_self=True)
+        self.assertEqual(descendants.next().pk, 5)
+        self.assertEqual([c.pk for c in descendants], [6, 7])
+
+    def test_get_descendants_on_deep_tree(self):
+        # Deeper than the recursion limit would allow a recursive walk
+        parent = None
+        for i in range(sys.getrecursionlimit() + 10):
+            parent = models.LoadTreeNode.objects.create(name=str(i),
+                                                        parent=parent)
+        root = parent.get_root()
+        descendants = root.get_descendants()
+        self.assertEqual(len(descendants), i)
+        self.assertEqual(descendants[-1].pk, parent.pk)
+
     def test_get_next_sibling(self):
         m = models.LoadTreeNode.objects
         self.assertEqual(m.get(pk=2).get_next_sibling().id, 5)
@@ -491,11 +1360,8 @@ class LoadTreeNodeTest(TestCase):
         child_copy = models.LoadTreeNode.objects.get(pk=3)
         self.assertEqual(child, child_copy)
         child_copy.name = 'Foo'
-        # This is not in the cached tree, so it won't clear the cache
+        # Saving any copy of a node in the tree clears the cache
         child_copy.save()
-        self.assertNotEqual(node.get_children()[0].name, 'Foo')
-        # Clear the cache
-        node.save()
         # Populate the cache again
         self.assertEqual(node.get_children()[0].name, 'Foo')
     
@@ -510,11 +1376,8 @@ class LoadTreeNodeTest(TestCase):
         child_copy = models.LoadTreeNode.objects.get(pk=2)
         self.assertEqual(child, child_copy)
         child_copy.name = 'Foo'
-        # This is not in the cached tree, so it won't clear the cache
+        # Saving any copy of a node in the tree clears the cache
         child_copy.save()
-        self.assertNotEqual(node.get_children()[0].name, 'Foo')
-        # Clear the cache
-        node.get_children()[1].save()
         # Populate the cache again
         self.assertEqual(node.get_children()[0].name, 'Foo')
     
@@ -531,9 +1394,6 @@ class LoadTreeNodeTest(TestCase):
         """
         Test that we can traverse the tree without hitting the database.
         """
-        # Queries aren't logged with debug switched off
-        original_debug = settings.DEBUG
-        settings.DEBUG = True
         query_count = len(connection.queries)
         node = models.LoadTreeNode.objects.get(pk=6)
         self.assertEqual(len(connection.queries), query_count + 1)
@@ -548,8 +1408,48 @@ class LoadTreeNodeTest(TestCase):
                 n.get_next_sibling()
                 n.get_previous_sibling()
                 n.get_siblings()
-        settings.DEBUG = original_debug
         self.assertEqual(len(connection.queries), query_count + 2)
-        
-        
 
+    def test_shared_cache(self):
+        """
+        Test that instances of the same tree share one loaded tree until
+        the request finishes.
+        """
+        node = models.LoadTreeNode.objects.get(pk=6)
+        other = models.LoadTreeNode.objects.get(pk=3)
+        query_count = len(connection.queries)
+        self.assertEqual([c.pk for c in node.get_ancestors()], [1, 5])
+        self.assertEqual([c.pk for c in other.get_ancestors()], [1, 2])
+        self.assert_(node.get_root() is other.get_root())
+        self.assertEqual(len(connection.queries), query_count + 1)
+        request_finished.send(sender=self.__class__)
+        node.get_children()
+        self.assertEqual(len(connection.queries), query_count + 2)
+
+
+class PartialLoadTreeNodeTest(QueryCountTestCase):
+    fixtures = ['partialloadtreenode.json']
+
+    def setUp(self):
+        super(PartialLoadTreeNodeTest, self).setUp()
+        request_finished.send(sender=self.__class__)
+
+    def test_lazy_loading(self):
+        m = models.PartialLoadTreeNode.objects
+        node = m.get(pk=6)
+        query_count = len(connection.queries)
+        # Loads the node's ancestors and children
+        self.assertEqual([c.pk for c in node.get_ancestors()], [1, 5])
+        self.assertEqual(node.get_children(), [])
+        self.assertEqual(len(connection.queries), query_count + 1)
+        # Loads the parent's children
+        self.assertEqual(node.get_next_sibling().pk, 7)
+        self.assertEqual(node.get_previous_sibling(), None)
+        self.assertEqual(len(connection.queries), query_count + 2)
+        # Loads the root's children, then the children of those which
+        # haven't been loaded yet
+        self.assertEqual([c.pk for c in node.get_root().get_descendants()],
+                         [2, 3, 4, 5, 6, 7, 8, 9, 10])
+        self.assertEqual(len(connection.queries), query_count + 5)
+        self.assertEqual([c.pk for c in m.get(pk=8).get_children()], [9, 10])
+        self.assertEqual(len(connection.queries), query_count + 6)
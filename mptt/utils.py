@@ -2,29 +2,43 @@
 Utilities for working with lists of model instances which represent
 trees.
 """
-import copy
-import itertools
+import bisect
+import operator
+import threading
+
+from django.core.signals import request_finished
+from django.db import connection
+from django.db.models.query import Q
+from django.utils.encoding import force_unicode
 
 __all__ = ('previous_current_next', 'tree_item_iterator',
-           'drilldown_tree_for_node')
+           'drilldown_tree_for_node', 'prefetch_tree_relations',
+           'add_tree_paths')
+
+# Caches kept for the current request in each thread, by name
+_request_caches = threading.local()
 
 def previous_current_next(items):
     """
-    From http://www.wordaligned.org/articles/zippy-triples-served-with-python
-
     Creates an iterator which returns (previous, current, next) triples,
     with ``None`` filling in when there is no previous or next
     available.
+
+    A single pass is made over ``items``, holding no more than three of
+    them at a time, so any iterable may be given - including iterators
+    which stream results from the database, such as those returned by a
+    ``QuerySet``'s ``iterator()`` method.
     """
-    extend = itertools.chain([None], items, [None])
-    previous, current, next = itertools.tee(extend, 3)
+    items = iter(items)
     try:
-        current.next()
-        next.next()
-        next.next()
+        current = items.next()
     except StopIteration:
-        pass
-    return itertools.izip(previous, current, next)
+        return
+    previous = None
+    for next in items:
+        yield previous, current, next
+        previous, current = current, next
+    yield previous, current, None
 
 def tree_item_iterator(items, ancestors=False):
     """
@@ -59,50 +73,52 @@ def tree_item_iterator(items, ancestors=False):
                    Dystopian Futures  ->  [u'Books', u'Sci-fi']
 
     """
-    structure = {}
     opts = None
+    closed_levels = []
     for previous, current, next in previous_current_next(items):
         if opts is None:
             opts = current._meta
 
         current_level = getattr(current, opts.level_attr)
         if previous:
-            structure['new_level'] = (getattr(previous,
-                                              opts.level_attr) < current_level)
+            new_level = getattr(previous, opts.level_attr) < current_level
             if ancestors:
                 # If the previous node was the end of any number of
                 # levels, remove the appropriate number of ancestors
                 # from the list.
-                if structure['closed_levels']:
-                    structure['ancestors'] = \
-                        structure['ancestors'][:-len(structure['closed_levels'])]
+                if closed_levels:
+                    del ancestor_list[-len(closed_levels):]
                 # If the current node is the start of a new level, add its
                 # parent to the ancestors list.
-                if structure['new_level']:
-                    structure['ancestors'].append(unicode(previous))
+                if new_level:
+                    ancestor_list.append(unicode(previous))
         else:
-            structure['new_level'] = True
+            new_level = True
             if ancestors:
                 # Set up the ancestors list on the first item
-                structure['ancestors'] = []
+                ancestor_list = []
 
         if next:
-            structure['closed_levels'] = range(current_level,
-                                               getattr(next,
-                                                       opts.level_attr), -1)
+            closed_levels = range(current_level,
+                                  getattr(next, opts.level_attr), -1)
         else:
             # All remaining levels need to be closed
-            structure['closed_levels'] = range(current_level, -1, -1)
+            closed_levels = range(current_level, -1, -1)
 
-        # Return a deep copy of the structure dict so this function can
-        # be used in situations where the iterator is consumed
-        # immediately.
-        yield current, copy.deepcopy(structure)
+        # Return a new structure dict each time so this function can be
+        # used in situations where the iterator is consumed immediately.
+        # Only the ancestors list is modified later, so only it needs to
+        # be copied.
+        structure = {'new_level': new_level, 'closed_levels': closed_levels}
+        if ancestors:
+            structure['ancestors'] = ancestor_list[:]
+        yield current, structure
 
 def drilldown_tree_for_node(node, rel_cls=None, rel_field=None, count_attr=None,
                             cumulative=False):
     """
-    Creates a drilldown tree for the given node. A drilldown tree
+    Creates a ``QuerySet`` containing the drilldown tree for the given
+    node, which is retrieved using a single query. A drilldown tree
     consists of a node's ancestors, itself and its immediate children,
     all in tree order.
 
@@ -126,9 +142,303 @@ def drilldown_tree_for_node(node, rel_cls=None, rel_field=None, count_attr=None,
        If ``True``, the count will be for each child and all of its
        descendants, otherwise it will be for each child itself.
     """
+    opts = node._meta
+    manager = node._tree_manager
+    # Query through the default manager, as get_ancestors() and
+    # get_children() do, so any rows it filters out are left out
+    queryset = node._default_manager.filter(Q(**{
+        opts.tree_id_attr: getattr(node, opts.tree_id_attr),
+    }) & (Q(**{
+        '%s__lt' % opts.left_attr: getattr(node, opts.left_attr),
+        '%s__gt' % opts.right_attr: getattr(node, opts.right_attr),
+    }) | Q(pk=node.pk) | Q(**{opts.parent_attr: node.pk}))).order_by(
+        opts.tree_id_attr, opts.left_attr)
     if rel_cls and rel_field and count_attr:
-        children = node._tree_manager.add_related_count(
-            node.get_children(), rel_cls, rel_field, count_attr, cumulative)
-    else:
-        children = node.get_children()
-    return itertools.chain(node.get_ancestors(), [node], children)
+        # Only count items for the node's children
+        qn = connection.ops.quote_name
+        subquery = manager._get_related_count_subquery(rel_cls, rel_field,
+                                                       cumulative)
+        queryset = queryset.extra(select={
+            count_attr: 'CASE WHEN %s.%s = %%s THEN %s END' % (
+                qn(opts.db_table),
+                qn(opts.get_field(opts.parent_attr).column), subquery),
+        }, select_params=[node.pk])
+    return queryset
+
+def prefetch_tree_relations(nodes, children=True, ancestors=False,
+                            descendants=False):
+    """
+    Loads the children, ancestors and/or descendants of every node in
+    ``nodes`` using a single query for each kind of relation, caching
+    them on each node so that its ``get_children()``,
+    ``get_ancestors()`` and ``get_descendants()`` methods don't need to
+    query the database.
+
+    Returns the list of nodes.
+
+    ``children``
+       If ``True``, the children of each node will be loaded. This
+       doesn't require a query of its own if ``descendants`` is also
+       ``True``.
+
+    ``ancestors``
+       If ``True``, the ancestors of each node will be loaded.
+
+    ``descendants``
+       If ``True``, the descendants of each node will be loaded. If a
+       number is given, only descendants which are at most that many
+       levels below each node will be loaded, as if retrieved using
+       ``get_descendants(max_depth=descendants)``.
+
+    Nodes are matched up with their relations using their tree fields,
+    which are assumed to be up to date.
+    """
+    nodes = list(nodes)
+    if not nodes:
+        return nodes
+    opts = nodes[0]._meta
+    manager = nodes[0]._tree_manager
+    parent_id_attr = '%s_id' % opts.parent_attr
+    parent_cache_name = opts.get_field(opts.parent_attr).get_cache_name()
+
+    def get_values(node):
+        return (getattr(node, opts.tree_id_attr),
+                getattr(node, opts.left_attr),
+                getattr(node, opts.right_attr))
+
+    def contains(node, other):
+        tree_id, left, right = get_values(node)
+        other_tree_id, other_left, other_right = get_values(other)
+        return (tree_id == other_tree_id and
+                left < other_left and other_right < right)
+
+    # Nodes in tree order, for finding nodes whose relations are already
+    # covered by the range of another node.
+    ordered = sorted(nodes, key=get_values)
+
+    if descendants:
+        max_depth = None
+        if descendants is not True:
+            max_depth = descendants
+        branches = [n for n in ordered if not n.is_leaf_node()]
+        # Descendants of nodes inside another node's range will be
+        # retrieved along with that node's descendants - unless they are
+        # limited by depth, in which case a nested node's descendants
+        # may reach deeper than the outer node's.
+        if max_depth is not None:
+            outermost = branches
+        else:
+            outermost = []
+            for node in branches:
+                if not outermost or not contains(outermost[-1], node):
+                    outermost.append(node)
+        filters = []
+        for node in outermost:
+            node_filters = {
+                opts.tree_id_attr: getattr(node, opts.tree_id_attr),
+                '%s__gt' % opts.left_attr: getattr(node, opts.left_attr),
+                '%s__lt' % opts.left_attr: getattr(node, opts.right_attr),
+            }
+            if max_depth is not None:
+                node_filters['%s__lte' % opts.level_attr] = \
+                    getattr(node, opts.level_attr) + max_depth
+            filters.append(Q(**node_filters))
+        rows = []
+        if filters:
+            rows = list(manager.filter(reduce(operator.or_, filters)))
+        # Each node's descendants are the rows between its left and
+        # right edges, which can be found by bisecting the rows in tree
+        # order.
+        rows.sort(key=get_values)
+        keys = [get_values(row)[:2] for row in rows]
+        for node in branches:
+            tree_id, left, right = get_values(node)
+            node_descendants = rows[bisect.bisect_right(keys, (tree_id, left)):
+                                    bisect.bisect_left(keys, (tree_id, right))]
+            if max_depth is not None:
+                max_level = getattr(node, opts.level_attr) + max_depth
+                node_descendants = [row for row in node_descendants
+                    if getattr(row, opts.level_attr) <= max_level]
+            node._get_traversal_cache()[('descendants', False, None, max_depth)] = \
+                _get_cached_queryset(
+                    manager.get_descendants(node, max_depth=max_depth),
+                    node_descendants)
+
+    if children:
+        branches = [n for n in nodes if not n.is_leaf_node()]
+        children_by_parent = dict([(n.pk, []) for n in branches])
+        if descendants:
+            rows = [row for row in rows
+                    if getattr(row, parent_id_attr) in children_by_parent]
+        elif branches:
+            rows = manager.filter(**{
+                '%s__in' % opts.parent_attr: children_by_parent.keys(),
+            })
+        else:
+            rows = []
+        for row in rows:
+            children_by_parent[getattr(row, parent_id_attr)].append(row)
+        for node in branches:
+            node_children = children_by_parent[node.pk]
+            for child in node_children:
+                setattr(child, parent_cache_name, node)
+            node._get_traversal_cache()['children'] = _get_cached_queryset(
+                manager.filter(**{opts.parent_attr: node}), node_children)
+
+    if ancestors:
+        child_nodes = [n for n in ordered if n.is_child_node()]
+        # Ancestors of a node with a descendant in the list will be
+        # retrieved along with that descendant's ancestors.
+        innermost = []
+        for i, node in enumerate(child_nodes):
+            if (i + 1 == len(child_nodes) or
+                not contains(node, child_nodes[i + 1])):
+                innermost.append(node)
+        # Ancestors are retrieved through the default manager, as they
+        # are by get_ancestors()
+        default_manager = nodes[0]._default_manager
+        rows = []
+        if innermost:
+            rows = list(default_manager.filter(reduce(operator.or_, [Q(**{
+                opts.tree_id_attr: getattr(node, opts.tree_id_attr),
+                '%s__lt' % opts.left_attr: getattr(node, opts.left_attr),
+                '%s__gt' % opts.right_attr: getattr(node, opts.right_attr),
+            }) for node in innermost])).order_by(opts.tree_id_attr,
+                                                  opts.left_attr))
+        # Walk the nodes and the rows in tree order, keeping a stack of
+        # the rows which contain the current item, which are the
+        # ancestors of any node reached. A node which is also one of the
+        # rows comes before it, as it doesn't contain itself.
+        items = [get_values(node)[:2] + (0, i)
+                 for i, node in enumerate(child_nodes)]
+        items.extend([get_values(row)[:2] + (1, i)
+                      for i, row in enumerate(rows)])
+        items.sort()
+        stack = []
+        for tree_id, left, is_row, i in items:
+            while stack and (get_values(stack[-1])[0] != tree_id or
+                             get_values(stack[-1])[2] < left):
+                stack.pop()
+            if is_row:
+                stack.append(rows[i])
+                continue
+            node = child_nodes[i]
+            node_ancestors = stack[:]
+            cache = node._get_traversal_cache()
+            cache[('ancestors', False)] = _get_cached_queryset(
+                manager.get_ancestors(node,
+                    queryset=default_manager.all()), node_ancestors)
+            node_ancestors = node_ancestors[:]
+            node_ancestors.reverse()
+            cache[('ancestors', True)] = _get_cached_queryset(
+                manager.get_ancestors(node, ascending=True,
+                    queryset=default_manager.all()), node_ancestors)
+
+    return nodes
+
+def add_tree_paths(nodes, path_attr, separator=u' :: ',
+                   include_self=False):
+    """
+    Adds an attribute named ``path_attr`` to every node in ``nodes``,
+    containing the unicode representations of its ancestors joined with
+    ``separator``, as the ``tree_path`` template filter would for the
+    node's ``get_ancestors()``. If ``include_self`` is ``True``, the
+    node itself will be included at the end of its path.
+
+    Ancestors are retrieved through the model's default manager, as
+    ``get_ancestors()`` retrieves them, so any it filters out are left
+    out of the paths.
+
+    The paths beneath the ancestors retrieved are kept until the current
+    request has finished or the tree changes, so ancestors are only
+    retrieved, using a single query, for nodes whose parents haven't
+    been seen before.
+
+    Returns a list of the nodes.
+    """
+    nodes = list(nodes)
+    if not nodes:
+        return nodes
+    opts = nodes[0]._meta
+    manager = nodes[0]._tree_manager
+    parent_id_attr = '%s_id' % opts.parent_attr
+    tree_id_attr = opts.tree_id_attr
+    left_attr = opts.left_attr
+    right_attr = opts.right_attr
+
+    version = manager.get_tree_version()
+    tables = _get_request_cache('tree_paths')
+    cached = tables.get(opts.db_table)
+    if cached is None or cached[0] != version:
+        cached = tables[opts.db_table] = (version, {None: ()})
+    # Maps the primary keys of nodes to the labels of the path of their
+    # children
+    paths = cached[1]
+
+    # Siblings have the same ancestors, so only retrieve them once
+    missing = dict([(getattr(node, parent_id_attr), node) for node in nodes
+                    if getattr(node, parent_id_attr) not in paths])
+    if missing:
+        rows = nodes[0]._default_manager.filter(reduce(operator.or_, [Q(**{
+            tree_id_attr: getattr(node, tree_id_attr),
+            '%s__lt' % left_attr: getattr(node, left_attr),
+            '%s__gt' % right_attr: getattr(node, right_attr),
+        }) for node in missing.values()]))
+        # Walk the rows and the nodes in tree order, keeping a stack of
+        # the rows which contain the current item. A node which is also
+        # one of the rows comes before it, as it doesn't contain itself.
+        items = [(getattr(node, tree_id_attr), getattr(node, left_attr),
+                  0, parent_id) for parent_id, node in missing.items()]
+        items.extend([(getattr(row, tree_id_attr), getattr(row, left_attr),
+                       1, row) for row in rows])
+        items.sort(key=lambda item: item[:3])
+        stack = []
+        for tree_id, left, is_row, item in items:
+            while stack and (getattr(stack[-1][0], tree_id_attr) != tree_id or
+                             getattr(stack[-1][0], right_attr) < left):
+                stack.pop()
+            if not is_row:
+                paths[item] = stack and stack[-1][1] or ()
+            else:
+                path = (stack and stack[-1][1] or ()) + (force_unicode(item),)
+                paths[item.pk] = path
+                stack.append((item, path))
+
+    for node in nodes:
+        path = paths[getattr(node, parent_id_attr)]
+        if include_self:
+            path = path + (force_unicode(node),)
+        setattr(node, path_attr, separator.join(path))
+    return nodes
+
+def _get_request_cache(name):
+    """
+    Returns the ``dict`` named ``name`` which is used to cache things in
+    the current thread for the rest of the current request.
+
+    Every cache is discarded when the request finishes, so changes made
+    by other processes will be seen by the next request.
+    """
+    caches = _request_caches.__dict__
+    cache = caches.get(name)
+    if cache is None:
+        cache = caches[name] = {}
+    return cache
+
+def _clear_request_caches(**kwargs):
+    """
+    Discards the caches kept for the current request in the current
+    thread.
+    """
+    _request_caches.__dict__.clear()
+
+request_finished.connect(_clear_request_caches)
+
+def _get_cached_queryset(queryset, results):
+    """
+    Fills the result cache of ``queryset`` with ``results``, which must
+    be the same model instances it would retrieve, so it may be used
+    without a database query.
+    """
+    queryset._result_cache = list(results)
+    return queryset
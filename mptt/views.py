@@ -0,0 +1,39 @@
+"""
+Views for working with trees.
+"""
+from django.http import Http404, HttpResponse
+from django.utils import simplejson
+from django.utils.encoding import smart_unicode
+
+__all__ = ('node_children',)
+
+def node_children(request, queryset, parent_id=None):
+    """
+    Returns a JSON list of the nodes in ``queryset`` which are children
+    of the node with the primary key ``parent_id``, or of the root nodes
+    in ``queryset`` if it isn't given. ``parent_id`` may also be given
+    in a ``parent`` GET parameter.
+
+    Each node is represented by an object with ``id``, ``label``,
+    ``level`` and ``is_leaf`` properties, which is enough for
+    client-side code to load a tree one level at a time, for example to
+    add options to a ``TreeNodeChoiceField`` with a ``max_level``.
+    """
+    opts = queryset.model._meta
+    if parent_id is None:
+        parent_id = request.GET.get('parent') or None
+    if parent_id is None:
+        nodes = queryset.filter(**{'%s__isnull' % opts.parent_attr: True})
+    else:
+        try:
+            parent = queryset.get(pk=parent_id)
+        except (queryset.model.DoesNotExist, ValueError):
+            raise Http404
+        nodes = queryset.filter(**{opts.parent_attr: parent})
+    data = [{
+        'id': node.pk,
+        'label': smart_unicode(node),
+        'level': getattr(node, opts.level_attr),
+        'is_leaf': node.is_leaf_node(),
+    } for node in nodes]
+    return HttpResponse(simplejson.dumps(data), mimetype='application/json')